@@ -0,0 +1,142 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adjacency of the provinces and municipalities from their boundaries.
+
+Two polygons are neighbours when they share a boundary vertex, once the
+coordinates are snapped to a grid. Only the pairs whose bounding boxes
+overlap are compared, found by sweeping the boxes sorted by their west
+edge. The adjacency is stored as a sparse matrix in `processed`, together
+with the ids indexing its rows and columns, and the incidence of the
+neighbours of all the units on all the dates is a sparse x dense product.
+"""
+
+import json
+import logging
+
+import numpy as np
+from scipy import sparse
+
+LOG = logging.getLogger(__name__)
+
+# Boundaries of each level, with the property holding the unit id
+LEVELS = {
+    "provinces": ("external/provincias-espana.geojson", "province id"),
+    "municipalities": ("external/municipios-cantabria.geojson", "COD_INE"),
+}
+
+# Grid (in degrees) on which the vertices are snapped before comparing them
+QUANTUM = 1e-6
+
+
+def vertices(geometry):
+    """All the vertices of the rings of a (multi)polygon."""
+    polygons = geometry["coordinates"]
+    if geometry["type"] == "Polygon":
+        polygons = [polygons]
+    return np.concatenate([
+        np.asarray(ring, dtype=float)[:, :2]
+        for polygon in polygons
+        for ring in polygon
+    ])
+
+
+def vertex_keys(points, quantum=QUANTUM):
+    """Sorted unique int64 keys of the snapped `points`."""
+    q = np.round(points / quantum).astype("int64")
+    return np.unique(q[:, 0] * (1 << 32) + q[:, 1])
+
+
+def candidate_pairs(boxes, tolerance=0.0):
+    """Pairs of the (min x, min y, max x, max y) `boxes` that overlap.
+
+    Once sorted by min x, the boxes that may overlap a box on x are the ones
+    after it up to the first whose min x is past its max x, so only those
+    are checked on y.
+    """
+    order = np.argsort(boxes[:, 0], kind="stable")
+    b = boxes[order]
+    start = np.arange(len(b)) + 1
+    end = np.searchsorted(b[:, 0], b[:, 2] + tolerance, side="right")
+    counts = np.maximum(end - start, 0)
+
+    i = np.repeat(np.arange(len(b)), counts)
+    j = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                             counts) +
+         np.repeat(start, counts))
+    ok = (b[j, 1] <= b[i, 3] + tolerance) & (b[i, 1] <= b[j, 3] + tolerance)
+    return order[i[ok]], order[j[ok]]
+
+
+def adjacency(features, quantum=QUANTUM):
+    """Symmetric units x units sparse matrix, one where two features share a
+    boundary vertex."""
+    points = [vertices(f["geometry"]) for f in features]
+    boxes = np.array([[*p.min(axis=0), *p.max(axis=0)] for p in points])
+    i, j = candidate_pairs(boxes, tolerance=quantum)
+
+    keys = [vertex_keys(p, quantum) for p in points]
+    touch = np.array([
+        np.intersect1d(keys[a], keys[b], assume_unique=True).size > 0
+        for a, b in zip(i, j)
+    ], dtype=bool)
+    LOG.info(f"{touch.sum()} neighbours out of {len(touch)} candidate "
+             f"pairs of {len(features)} units")
+
+    i, j = i[touch], j[touch]
+    n = len(features)
+    return sparse.csr_matrix(
+        (np.ones(2 * len(i), dtype="float32"), (np.r_[i, j], np.r_[j, i])),
+        shape=(n, n),
+    )
+
+
+def spatial_lag(adj, values):
+    """Mean of the values of the neighbours of each unit, on each date.
+
+    `values` is a dates x units array aligned with `adj`. Neighbours without
+    a value are left out, and units without any are NaN. All the dates are
+    done at once, as sparse x dense matrix products.
+    """
+    ok = np.isfinite(values)
+    total = adj @ np.where(ok, values, 0).T
+    count = adj @ ok.T.astype(adj.dtype)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (total / count).T.astype(values.dtype)
+
+
+def write_adjacency(base_dir):
+    """Write the adjacency of each of `LEVELS` to `processed`, sorted by
+    id."""
+    for name, (f, key) in LEVELS.items():
+        with open(base_dir / f) as fd:
+            features = json.load(fd)["features"]
+        ids = np.array([int(f["properties"][key]) for f in features])
+        order = np.argsort(ids)
+        adj = adjacency([features[k] for k in order])
+
+        sparse.save_npz(base_dir / "processed" / f"{name}-adjacency.npz",
+                        adj)
+        np.savez(base_dir / "processed" / f"{name}-adjacency-index.npz",
+                 ids=ids[order])
+
+
+def read_adjacency(base_dir, name):
+    """Ids and sparse adjacency of the `name` level in `LEVELS`."""
+    adj = sparse.load_npz(base_dir / "processed" / f"{name}-adjacency.npz")
+    with np.load(base_dir / "processed" /
+                 f"{name}-adjacency-index.npz") as f:
+        ids = f["ids"]
+    return ids, adj
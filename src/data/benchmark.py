@@ -0,0 +1,207 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of the data pipeline on synthetic data.
+
+Each function is timed (best of several runs) and memory-profiled (peak of
+the memory traced by `tracemalloc` in a separate run) for each of `SIZES`,
+and the results are compared with a stored baseline.
+"""
+
+import datetime
+import json
+import logging
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import pandas as pd
+
+import make_dataset
+import synthetic
+import utils
+
+LOG = logging.getLogger(__name__)
+
+# Synthetic data sets, see `synthetic.generate`
+SIZES = {
+    "small": {"days": 60, "n_provinces": 20, "density": 0.5},
+    "medium": {"days": 365, "n_provinces": None, "density": 1.0},
+    "large": {"days": 730, "n_provinces": None, "density": 1.0},
+}
+
+BENCHMARK_DIR = synthetic.PROJECT_DIR / "reports" / "benchmarks"
+
+
+def measure(func, setup, repeat=3):
+    """Best wall time and peak traced memory of `func(*setup())`.
+
+    `setup` is called before each run and is not measured.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        t = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t)
+
+    # Tracing slows down the run, so the memory is measured apart
+    args = setup()
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"time (s)": min(times), "peak memory (MB)": peak / 2 ** 20}
+
+
+def read_raw_cases(base_dir):
+    """Raw cases as `make_dataset.read_cases` has them before adding the
+    province info."""
+    raw = pd.read_csv(
+        base_dir / "raw" / "casos_tecnica_provincias.csv",
+        keep_default_na=False,
+    )
+    df = raw.iloc[:, [0, 1, 3]].copy()
+    df.columns = ["province iso", "date", "cases new (pcr)"]
+    df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d")
+    return df.replace("NC", "NA")
+
+
+def without_history(base_dir):
+    """Remove the Cantabria history, so that it is built from scratch."""
+    f = base_dir / "processed" / "cantabria-history.csv"
+    f.unlink(missing_ok=True)
+    return (base_dir,)
+
+
+def run_size(base_dir, repeat=3):
+    """Benchmark each pipeline function on the data in `base_dir`."""
+    raw = read_raw_cases(base_dir)
+    prov = pd.read_csv(base_dir / "external" / "provincias-ine.csv", sep=";")
+    cases = make_dataset.read_cases(base_dir)
+    cases = make_dataset.calculate_cumulative(cases)
+
+    benchmarks = {
+        "add_province_info": (
+            utils.add_province_info,
+            lambda: (raw.copy(), prov),
+        ),
+        "calculate_incidence": (
+            make_dataset.calculate_incidence,
+            lambda: (cases.copy(), base_dir),
+        ),
+        "calculate_incidence_cantabria": (
+            make_dataset.calculate_incidence_cantabria,
+            lambda: without_history(base_dir),
+        ),
+        "prepare_dataset": (
+            make_dataset.prepare_dataset,
+            lambda: (base_dir,),
+        ),
+    }
+
+    results = {}
+    for name, (func, setup) in benchmarks.items():
+        results[name] = measure(func, setup, repeat=repeat)
+        LOG.info(f"{name}: {results[name]['time (s)']:.3f}s, "
+                 f"{results[name]['peak memory (MB)']:.1f}MB")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Measures over their baseline by more than `tolerance` (relative)."""
+    regressions = []
+    for size, functions in results.items():
+        for name, measures in functions.items():
+            for k, v in measures.items():
+                ref = baseline.get(size, {}).get(name, {}).get(k)
+                if ref is not None and v > ref * (1 + tolerance):
+                    regressions.append(f"{size} {name} {k}: "
+                                       f"{v:.3f} over {ref:.3f}")
+    return regressions
+
+
+@click.command()
+@click.option('--size', 'sizes', type=click.Choice(list(SIZES)),
+              multiple=True, default=["small", "medium"],
+              show_default=True, help="Data sets to benchmark.")
+@click.option('--repeat', type=int, default=3, show_default=True,
+              help="Timed runs of each function, the best is kept.")
+@click.option('--tolerance', type=float, default=0.25, show_default=True,
+              help="Relative increase over the baseline taken as regression.")
+@click.option('--save-baseline', is_flag=True,
+              help="Store the results as the new baseline.")
+def main(sizes, repeat, tolerance, save_baseline):
+    """ Benchmarks the data pipeline functions on synthetic data, saving the
+        results in (../../reports/benchmarks) and failing if they regress
+        from the stored baseline, or if there is none.
+    """
+    results = {}
+    for size in sizes:
+        LOG.info(f"Benchmarking size '{size}': {SIZES[size]}")
+        with tempfile.TemporaryDirectory() as d:
+            base_dir = pathlib.Path(d)
+            synthetic.generate(base_dir, **SIZES[size])
+            results[size] = run_size(base_dir, repeat=repeat)
+
+    BENCHMARK_DIR.mkdir(parents=True, exist_ok=True)
+    now = datetime.datetime.now()
+    f = BENCHMARK_DIR / f"benchmark-{now:%Y%m%dT%H%M%S}.json"
+    with open(f, "w") as fd:
+        json.dump(results, fd, indent=2)
+    LOG.info(f"Results written to '{f}'")
+
+    f = BENCHMARK_DIR / "baseline.json"
+    if save_baseline:
+        baseline = {}
+        if f.exists():
+            with open(f, "r") as fd:
+                baseline = json.load(fd)
+        baseline.update(results)
+        with open(f, "w") as fd:
+            json.dump(baseline, fd, indent=2)
+        LOG.info(f"Baseline saved to '{f}'")
+        return
+
+    if not f.exists():
+        LOG.error(f"No baseline to compare with in '{f}', run with "
+                  "--save-baseline first")
+        sys.exit(1)
+
+    with open(f, "r") as fd:
+        regressions = compare(results, json.load(fd), tolerance)
+    for r in regressions:
+        LOG.error(f"Regression: {r}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    # not used in this stub but often useful for finding various files
+    project_dir = pathlib.Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
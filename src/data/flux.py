@@ -0,0 +1,190 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dense representation of the mobility fluxes between provinces.
+
+The fluxes are kept as a dates x origin x destination float32 tensor, stored
+as a `.npy` file that can be memory-mapped, together with the dates and the
+province ids indexing its axes.
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+
+
+def index(mob):
+    """Dates and province ids indexing the flux tensor of `mob`."""
+    dates = pd.DatetimeIndex(mob["date"].unique()).sort_values()
+    ids = np.union1d(mob["province id origin"].unique(),
+                     mob["province id destination"].unique())
+    return dates, ids
+
+
+def fill_tensor(tensor, mob, dates, ids):
+    """Scatter the long-format fluxes of `mob` into `tensor`.
+
+    Missing fluxes are left as zero, i.e. no trips.
+    """
+    t = dates.get_indexer(mob["date"])
+    o = np.searchsorted(ids, mob["province id origin"])
+    d = np.searchsorted(ids, mob["province id destination"])
+    tensor[t, o, d] = mob["flux"].values
+    return tensor
+
+
+def flux_tensor(mob, dtype="float32"):
+    """Dense dates x origin x destination tensor of the fluxes in `mob`."""
+    dates, ids = index(mob)
+    tensor = np.zeros((len(dates), len(ids), len(ids)), dtype=dtype)
+    return dates, ids, fill_tensor(tensor, mob, dates, ids)
+
+
+def write_flux_tensor(read_chunks, base_dir):
+    """Write the flux tensor of the fluxes in chunks to `processed`.
+
+    `read_chunks` returns an iterator over the long-format fluxes in chunks,
+    and is called twice: once to find the axes of the tensor and once to
+    fill it. The tensor is filled directly in a memory-mapped file, so
+    neither the fluxes nor the tensor need to be whole in memory. With no
+    fluxes, the tensor is empty.
+    """
+    dates, ids = [pd.DatetimeIndex([])], [np.array([], dtype="int32")]
+    for mob in read_chunks():
+        d, i = index(mob)
+        dates.append(d)
+        ids.append(i)
+    dates = pd.DatetimeIndex(np.unique(np.concatenate(dates)))
+    ids = np.unique(np.concatenate(ids))
+
+    tensor = np.lib.format.open_memmap(
+        base_dir / "processed" / "province-flux.npy",
+        mode="w+",
+        dtype="float32",
+        shape=(len(dates), len(ids), len(ids)),
+    )
+    for mob in read_chunks():
+        fill_tensor(tensor, mob, dates, ids)
+    tensor.flush()
+
+    np.savez(
+        base_dir / "processed" / "province-flux-index.npz",
+        dates=dates.values.astype("datetime64[D]"),
+        ids=ids,
+    )
+
+
+def append_flux_tensor(read_chunks, base_dir):
+    """Append to the flux tensor in `processed` the dates after its last.
+
+    `read_chunks` is as in `write_flux_tensor`, but is called once, keeping
+    only the rows of the new dates. Their fluxes are written at the end of
+    the `.npy` file, whose header is updated in place, so the dates already
+    in the tensor are neither read nor written. Returns False, leaving the
+    tensor as is, if it cannot be extended: the new fluxes have provinces
+    not in it, or the header cannot hold the new shape. It must then be
+    written again with `write_flux_tensor`.
+    """
+    dates, ids, _ = read_flux_tensor(base_dir)
+    columns = ["date", "province id origin", "province id destination",
+               "flux"]
+    new = [mob.loc[mob["date"] > dates.max(), columns] if len(dates)
+           else mob[columns] for mob in read_chunks()]
+    new = pd.concat(new, ignore_index=True) if new else pd.DataFrame()
+    if new.empty:
+        return True
+
+    new_dates, new_ids = index(new)
+    if not np.isin(new_ids, ids).all():
+        return False
+
+    f = base_dir / "processed" / "province-flux.npy"
+    with open(f, "r+b") as fd:
+        if np.lib.format.read_magic(fd) != (1, 0):
+            return False
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(fd)
+        offset = fd.tell()
+
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": fortran,
+            "shape": (shape[0] + len(new_dates),) + shape[1:],
+        })
+        if fortran or len(header.getvalue()) != offset:
+            return False
+
+        block = np.zeros((len(new_dates), len(ids), len(ids)), dtype=dtype)
+        fill_tensor(block, new, new_dates, ids)
+        fd.seek(offset + int(np.prod(shape)) * dtype.itemsize)
+        fd.write(block.tobytes())
+        fd.seek(0)
+        fd.write(header.getvalue())
+
+    np.savez(
+        base_dir / "processed" / "province-flux-index.npz",
+        dates=dates.append(new_dates).values.astype("datetime64[D]"),
+        ids=ids,
+    )
+    return True
+
+
+def read_flux_tensor(base_dir, mmap_mode="r"):
+    """Read the flux tensor from `processed`, memory-mapped by default."""
+    tensor = np.load(
+        base_dir / "processed" / "province-flux.npy",
+        mmap_mode=mmap_mode,
+    )
+    with np.load(base_dir / "processed" / "province-flux-index.npz") as f:
+        dates = pd.DatetimeIndex(f["dates"])
+        ids = f["ids"]
+    return dates, ids, tensor
+
+
+def positions(df, dates, ids):
+    """Positions of the rows of `df` in the date and province axes.
+
+    Also returns a mask of the rows whose date and province are in the axes.
+    """
+    t = dates.get_indexer(df["date"])
+    p = np.searchsorted(ids, df["province id"])
+    ok = (t >= 0) & (p < len(ids))
+    ok[ok] = ids[p[ok]] == df["province id"].values[ok]
+    return t, p, ok
+
+
+def province_matrix(df, column, dates, ids, dtype="float32", fill=0):
+    """Dates x provinces matrix of `column`, aligned with a flux tensor.
+
+    Dates or provinces not in `df` are left as `fill`.
+    """
+    matrix = np.full((len(dates), len(ids)), fill, dtype=dtype)
+    t, p, ok = positions(df, dates, ids)
+    matrix[t[ok], p[ok]] = df[column].values[ok]
+    return matrix
+
+
+def mobility_weighted(tensor, values, intra=False):
+    """Sum over the origins of flux x origin values, for each destination.
+
+    `values` is a dates x provinces matrix aligned with `tensor`. The product
+    is done as one batched matrix product over all the dates. Fluxes within a
+    province are left out unless `intra` is set.
+    """
+    result = np.matmul(values[:, None, :], tensor)[:, 0, :]
+    if not intra:
+        result -= np.diagonal(tensor, axis1=1, axis2=2) * values
+    return result
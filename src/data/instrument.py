@@ -0,0 +1,160 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timing and memory instrumentation of the pipeline stages.
+
+Each instrumented block adds a record with its wall time, CPU time, the
+peak of the resident memory of the process within the block, its increase
+over the memory at the start of the block, and the rows it produced. The resident memory is
+sampled in a background thread while the block runs (on Linux, where it can
+be read from /proc). Records are kept per process, see `recording` to bring
+back those of worker processes.
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+LOG = logging.getLogger(__name__)
+
+COLUMNS = [
+    "stage",
+    "pid",
+    "rows",
+    "wall time (s)",
+    "cpu time (s)",
+    "peak rss (MB)",
+    "peak rss increase (MB)",
+]
+
+# Seconds between samples of the resident memory
+SAMPLE_INTERVAL = 0.01
+
+_records = []
+
+
+def rss():
+    """Resident memory of the process, in MB, or None if it is unknown."""
+    try:
+        with open("/proc/self/statm") as fd:
+            pages = int(fd.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+class PeakSampler(threading.Thread):
+    """Sample the resident memory until `stop`, keeping its peak."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def stop(self):
+        """Stop sampling and return the peak, including the memory now."""
+        self._done.set()
+        self.join()
+        self.peak = max(self.peak, rss())
+        return self.peak
+
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """Record the enclosed block as the stage `name`.
+
+    Yields the record, so that its "rows" can be set within the block.
+    """
+    record = {"stage": name, "pid": os.getpid(), "rows": rows}
+    sampler = PeakSampler()
+    if sampler.peak is not None:
+        sampler.start()
+    start = sampler.peak
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall time (s)"] = time.perf_counter() - wall
+        record["cpu time (s)"] = time.process_time() - cpu
+        if start is not None:
+            record["peak rss (MB)"] = sampler.stop()
+            record["peak rss increase (MB)"] = record["peak rss (MB)"] - start
+        _records.append(record)
+
+
+@contextlib.contextmanager
+def recording():
+    """Take out the records added within the block into the yielded list.
+
+    Used in worker processes, to return their records to the parent, which
+    adds them with `extend`.
+    """
+    start = len(_records)
+    records = []
+    try:
+        yield records
+    finally:
+        records.extend(_records[start:])
+        del _records[start:]
+
+
+def extend(records):
+    _records.extend(records)
+
+
+def records():
+    df = pd.DataFrame(_records, columns=COLUMNS)
+    df["rows"] = df["rows"].astype("Int64")
+    for c in ["peak rss (MB)", "peak rss increase (MB)"]:
+        df[c] = df[c].astype("float")
+    return df
+
+
+def write_report(report_dir, name="pipeline", logger=None):
+    """Write the records as JSON and CSV run reports in `report_dir`.
+
+    The reports are named after `name` and the current time. The records
+    are also logged to `logger`, if given.
+    """
+    df = records()
+    if logger is not None:
+        for r in df.itertuples(index=False):
+            logger.info(f"{r[0]}: {r[3]:.2f}s wall, {r[4]:.2f}s cpu, "
+                        f"{r[5]:.0f}MB peak rss "
+                        f"({r[6]:+.0f}MB), {r[2]} rows")
+
+    now = datetime.datetime.now()
+    f = report_dir / f"{name}-{now:%Y%m%dT%H%M%S}"
+    report_dir.mkdir(parents=True, exist_ok=True)
+    with open(f.with_suffix(".json"), "w") as fd:
+        json.dump(
+            {"date": now.isoformat(timespec="seconds"),
+             "stages": json.loads(df.to_json(orient="records"))},
+            fd,
+            indent=2,
+        )
+    df.to_csv(f.with_suffix(".csv"), index=False)
+    (logger or LOG).info(f"Run report written to '{f}.json'")
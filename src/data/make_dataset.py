@@ -13,15 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import hashlib
+import json
 import logging
 import pathlib
+import shutil
 import sys
 
 import click
 from dotenv import find_dotenv, load_dotenv
+import joblib
 import numpy as np
 import pandas as pd
 
+import adjacency
+import flux
+import instrument
 import utils
 
 log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -38,9 +46,76 @@ FILES = [
     "external/provincias-ine.csv",
     "external/province-population.csv",
     "external/municipios-cantabria.geojson",
+    "external/provincias-espana.geojson",
     "external/population-cantabria.csv",
 ]
 
+# Days over which the incidence is accumulated
+WINDOWS = (7, 14)
+
+# Rows read at once from the raw files
+CHUNKSIZE = 1000000
+
+# Compact dtypes of the raw fluxes
+FLUX_DTYPES = {
+    "province origin": "category",
+    "province destination": "category",
+    "province id origin": "int32",
+    "province id destination": "int32",
+    "flux": "float32",
+}
+
+# Formats in which the processed datasets can be written
+OUTPUT_FORMATS = ("csv", "parquet")
+
+# Files that appends may leave in a Parquet directory before it is compacted
+PARQUET_MAX_FILES = 8
+
+# Version of the layout of the state files, bumped when it changes so that
+# incremental runs do a full rebuild instead of misreading an older state
+STATE_VERSION = 1
+
+# Run reports with the timing and memory of the stages
+REPORT_DIR = pathlib.Path(__file__).resolve().parents[2] / "reports"
+
+# Inputs (from `FILES`) and outputs (in `processed`) of each pipeline stage
+STAGES = {
+    "provinces": {
+        "inputs": [
+            "raw/casos_tecnica_provincias.csv",
+            "raw/province_flux.csv",
+            "external/provincias-ine.csv",
+            "external/province-population.csv",
+        ],
+        "outputs": [
+            "provinces-incidence.{fmt}",
+            "provinces-incidence-mobility.{fmt}",
+            "provinces-state.json",
+            "province-flux.npy",
+            "province-flux-index.npz",
+        ],
+    },
+    "cantabria": {
+        "inputs": [
+            "raw/COVID19_municipalizado.csv",
+            "external/population-cantabria.csv",
+        ],
+        "outputs": [
+            "cantabria-history.{fmt}",
+            "cantabria-incidence.{fmt}",
+            "cantabria-state.json",
+        ],
+    },
+    "adjacency": {
+        "inputs": [f for f, _ in adjacency.LEVELS.values()],
+        "outputs": [
+            f"{name}-adjacency{suffix}.npz"
+            for name in adjacency.LEVELS
+            for suffix in ["", "-index"]
+        ],
+    },
+}
+
 
 def check_data(base_dir):
     LOG.info(f"Checking for needed data in '{base_dir}'")
@@ -55,164 +130,512 @@ def check_data(base_dir):
         sys.exit(1)
 
 
-def read_population(base_dir):
-    df = pd.read_csv(
-        base_dir / "external" / "province-population.csv",
-        sep=";"
-    )
-    df = df.loc[
-        (df["Sexo"] == "Total") &
-        (df["Provincias"] != "Total") &
-        (df["Periodo"] == 2019)
-    ]
-    df["province id"] = df["Provincias"].apply(lambda x: int(x.split()[0]))
-    df["Total"] = df["Total"].apply(lambda x: int(x.replace(".", "")))
-    df = df[["province id", "Total"]]
+def calculate_incidence(df, base_dir, history=None, first=None):
+    """Add the incidence over the last `WINDOWS` days, per 100k inhabitants.
 
-    return df
+    Windows are calendar days, days without data counting as no cases.
+    `history` holds, for incremental runs, the rows of the last days already
+    processed, so that the windows spanning both runs are complete, and
+    `first` the first date of each province.
+    """
+    pop = utils.read_population(base_dir)
 
+    cases = df[["province id", "date", "cases new (pcr)"]]
+    if history is not None:
+        cases = pd.concat([history[cases.columns], cases], ignore_index=True)
 
-def calculate_incidence(df, base_dir):
-    pop = read_population(base_dir)
+    sums = utils.window_sums(cases, "province id", "cases new (pcr)",
+                             WINDOWS, first=first)
+    for w in WINDOWS:
+        df[f"incidence {w}"] = sums[w][cases.shape[0] - df.shape[0]:]
 
     df = df.merge(
         pop,
         on="province id"
     )
 
-    for w in (7, 14):
-        df[f"incidence {w}"] = df.groupby("province")["cases new (pcr)"].apply(lambda x: x.rolling(window=w).sum())  # noqa
+    for w in WINDOWS:
         df[f"incidence {w}"] = (df[f"incidence {w}"] / df["Total"] * 100000).round().fillna(value=0).astype("int")  # noqa
 
     df = df.drop(columns="Total")
     return df
 
 
-def prepare_dataset(base_dir):
-    df = pd.read_csv(
-        base_dir / "raw" / "casos_tecnica_provincias.csv",
-        keep_default_na=False
-    )
+def read_flux_dates(df, base_dir):
+    """Slice of the flux tensor in `processed` with the dates of `df`.
 
-    columns = ["province iso", "date",
-               "cases new", "cases new (pcr)", "cases new (ac)",
-               "cases new (ag)", "cases new (elisa)", "cases new (unk)"]
-    df.columns = columns
+    Only those dates are read from the memory-mapped tensor. Returns the
+    dates and province ids of its axes, and the slice.
+    """
+    dates, ids, tensor = flux.read_flux_tensor(base_dir)
+    keep = np.flatnonzero(dates.isin(df["date"].unique()))
+    return dates[keep], ids, np.asarray(tensor[keep])
 
-    # Combine the 'NA' and 'NC' iso codes (both corresponding to Navarra)
-    df = df.replace('NC', 'NA')
-    df = df.groupby(['province iso', 'date']).sum().reset_index()
 
-    # Only use the colums that we need
-    columns = ["province iso", "date", "cases new (pcr)"]
-    df = df[columns]
-    df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d")
+def calculate_imported_risk(df, dates, ids, tensor, base_dir):
+    """Add the incidence brought into each province by the mobility.
 
-    prov = pd.read_csv(
-        base_dir / "external" / "provincias-ine.csv",
-        sep=";"
-    )
+    For each date and destination, this is the sum over the other provinces
+    of the flux from them times their incidence, per inhabitant of the
+    destination. It is computed for all the dates at once on the flux
+    tensor of `read_flux_dates`.
+    """
+    pop = utils.read_population(base_dir).set_index("province id")["Total"]
 
-    utils.add_province_info(df, prov)
+    with instrument.stage("imported risk", rows=df.shape[0]):
+        tensor = tensor.astype("float64")
+        t, p, ok = flux.positions(df, dates, ids)
 
+        for w in WINDOWS:
+            values = flux.province_matrix(df, f"incidence {w}", dates, ids,
+                                          dtype="float64")
+            risk = flux.mobility_weighted(tensor, values)
+            risk /= pop.reindex(ids).values
+
+            df[f"imported risk {w}"] = np.nan
+            df.loc[ok, f"imported risk {w}"] = risk[t[ok], p[ok]]
+
+    return df
+
+
+def calculate_cumulative(df, last=None):
+    """Add accumulated cases and their percentual increment.
+
+    `last` maps each province id to its accumulated cases on the last date of
+    a previous run, for incremental runs.
+    """
     cols = ["cases new (pcr)"]
 
     # Calculate cumulative cases
     new_cols = [i.replace("new", "acc") for i in cols]
     df[new_cols] = df.groupby('province id')[cols].cumsum()
+    if last is not None:
+        offset = df["province id"].map(last)
+        for c in new_cols:
+            df[c] += offset.fillna(0).astype("int")
+
+    prev = df.groupby('province id')[new_cols].shift()
+    if last is not None:
+        for c in new_cols:
+            prev[c] = prev[c].fillna(offset)
 
     # Calculate cases increment in percentage
     cols = new_cols
     new_cols = [i.replace("acc", "inc") for i in cols]
-    df[new_cols] = df.groupby(['province'])[cols].pct_change() * 100
+    df[new_cols] = (df[cols] / prev[cols].values - 1) * 100
     df[new_cols] = df[new_cols].fillna(value=0)
 
-    # Now add incidence data
-    df = calculate_incidence(df, base_dir)
+    return df
+
+
+def calculate_provinces(df, base_dir, last=None, history=None, first=None):
+    """Add the accumulated cases and incidence of the provinces in `df`."""
+    with instrument.stage("cumsum/pct_change", rows=df.shape[0]):
+        df = calculate_cumulative(df, last=last)
+    with instrument.stage("incidence", rows=df.shape[0]):
+        return calculate_incidence(df, base_dir, history=history,
+                                   first=first)
+
 
-    f = base_dir / "processed" / "provinces-incidence.csv"
-    LOG.info(f"Writing province data to '{f}', {df.shape[0]} observations")
-    df.to_csv(
+def calculate_provinces_job(*args):
+    """Run `calculate_provinces` in a worker, returning also its records."""
+    with instrument.recording() as records:
+        df = calculate_provinces(*args)
+    return df, records
+
+
+def calculate_provinces_parallel(df, base_dir, jobs=1, last=None,
+                                 history=None, first=None):
+    """Run `calculate_provinces` with the provinces split over `jobs`.
+
+    Provinces are independent, so they are split in one partition per
+    process and the results are put back together in partition order.
+    """
+    ids = np.sort(df["province id"].unique())
+    jobs = min(joblib.effective_n_jobs(jobs), max(len(ids), 1))
+    if jobs == 1:
+        return calculate_provinces(df, base_dir, last=last, history=history,
+                                   first=first)
+
+    tasks = []
+    for part in np.array_split(ids, jobs):
+        aux = df.loc[df["province id"].isin(part)].reset_index(drop=True)
+        if history is not None:
+            h = history.loc[history["province id"].isin(part)]
+        else:
+            h = None
+        tasks.append(
+            joblib.delayed(calculate_provinces_job)(aux, base_dir, last, h,
+                                                    first)
+        )
+
+    LOG.info(f"Processing {len(ids)} provinces in {jobs} processes")
+    parts = joblib.Parallel(n_jobs=jobs)(tasks)
+    for _, records in parts:
+        instrument.extend(records)
+    return pd.concat([df for df, _ in parts], ignore_index=True)
+
+
+def read_cases(base_dir, after=None, chunksize=CHUNKSIZE):
+    """Read the PCR cases of each province and date.
+
+    The raw file is read in chunks of `chunksize` rows with compact dtypes,
+    and each chunk is summed by province and date before taking the next,
+    so memory is bounded by the chunk size. Only the dates after `after`
+    are kept, if given.
+    """
+    f = base_dir / "raw" / "casos_tecnica_provincias.csv"
+    raw = pd.read_csv(f, nrows=0).columns
+
+    # Only use the colums that we need
+    columns = ["province iso", "date", "cases new (pcr)"]
+    chunks = pd.read_csv(
         f,
-        index=False,
+        usecols=[raw[0], raw[1], raw[3]],
+        dtype={raw[0]: "str", raw[1]: "str", raw[3]: "int32"},
+        keep_default_na=False,
+        chunksize=chunksize,
+    )
+
+    with instrument.stage("read cases") as record:
+        parts = []
+        for df in chunks:
+            df.columns = columns
+            df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d")
+            if after is not None:
+                df = df.loc[df["date"] > after]
+
+            # Combine the 'NA' and 'NC' iso codes (both for Navarra)
+            df = df.replace('NC', 'NA')
+            parts.append(df.groupby(['province iso', 'date']).sum())
+
+        if parts:
+            df = pd.concat(parts).groupby(level=[0, 1]).sum().reset_index()
+        else:
+            df = pd.DataFrame(columns=columns)
+        df["cases new (pcr)"] = df["cases new (pcr)"].astype("int32")
+        record["rows"] = df.shape[0]
+
+    prov = pd.read_csv(
+        base_dir / "external" / "provincias-ine.csv",
+        sep=";"
     )
 
-    # Now generate a dataset `aux_mob` that contains a column-based matrix of mobility
-    # fluxes, with the rows the destination province, columns the origin.
-    mob = pd.read_csv(
+    with instrument.stage("add_province_info", rows=df.shape[0]):
+        utils.add_province_info(df, prov)
+
+    return df
+
+
+def read_flux_chunks(base_dir, chunksize=CHUNKSIZE):
+    """Iterate over the raw fluxes in chunks, with compact dtypes."""
+    return pd.read_csv(
         base_dir / "raw" / "province_flux.csv",
         parse_dates=[0],
+        dtype=FLUX_DTYPES,
+        chunksize=chunksize,
     )
 
-    mob = mob.drop(columns=['province id destination', 'province id origin'])
 
-    mob_inter = mob[mob['province origin'] != mob['province destination']]
-    mob_intra = mob[mob['province origin'] == mob['province destination']]
-    mob_intra = mob_intra.drop(columns=['province destination'])
+def merge_mobility(df, dates, ids, tensor, base_dir):
+    """Join the province incidence with the mobility fluxes.
+
+    Each row of a destination province gets, for each origin province, the
+    flux from it and its incidence, as a two-level (origin, metric) column.
+    Those of the destination itself are left as NaN, since they are already
+    in its `flux intra` and incidence. The columns are taken from the flux
+    tensor of `read_flux_dates` and a dates x provinces matrix of each
+    incidence, with no intermediate long-format frames.
+
+    The origins are all the provinces of the tensor, whether they have
+    cases on the dates of `df` or not, so that runs over different dates
+    get the same columns.
+    """
+    with instrument.stage("mobility dataset") as record:
+        t, p, ok = flux.positions(df, dates, ids)
+        df = df.loc[ok].reset_index(drop=True)
+        t, p = t[ok], p[ok]
+
+        # Origins, in the order of their columns
+        origins = utils.province_names(base_dir).reindex(ids).dropna()
+        origins = origins.sort_values()
+        q = np.searchsorted(ids, origins.index.values)
+
+        metrics = {
+            "flux": tensor[t[:, None], q[None, :], p[:, None]],
+        }
+        for w in WINDOWS:
+            values = flux.province_matrix(df, f"incidence {w}", dates, ids,
+                                          dtype="float64", fill=np.nan)
+            metrics[f"incidence {w}"] = values[t[:, None], q[None, :]]
+
+        names = sorted(metrics)
+        block = np.stack([metrics[m] for m in names], axis=2).astype("float")
+        block[q[None, :] == p[:, None]] = np.nan
+        block = pd.DataFrame(
+            block.reshape(df.shape[0], len(q) * len(names)),
+            columns=pd.MultiIndex.from_product([origins.values, names]),
+        )
+
+        df["flux intra"] = tensor[t, p, p]
+        cols = [
+            'date',
+            'province',
+            'province id',
+            'region',
+            'region id',
+            'cases new (pcr)',
+            'cases acc (pcr)',
+            'cases inc (pcr)',
+            'incidence 14',
+            'incidence 7',
+            'flux intra',
+            'imported risk 14',
+            'imported risk 7',
+        ]
+        df = df[cols]
+        df.columns = pd.MultiIndex.from_product([cols, [""]])
+
+        merged = pd.concat([df, block], axis=1)
+        merged = merged.sort_values(by=[("date", ""), ("province", "")],
+                                    ignore_index=True)
+        record["rows"] = merged.shape[0]
+
+    return merged
 
-    aux_mob = mob_inter.merge(
-        df,
-        left_on=["province origin", "date"],
-        right_on=["province", "date"]
-    )
-    aux_mob = aux_mob.pivot(
-        index=["date", "province destination"],
-        columns="province origin",
-        values=["incidence 7", "incidence 14", "flux"],
-    ).reset_index()
-
-    # Switch levels so that province is on top of flux and incidences
-    aux_mob.columns = aux_mob.columns.swaplevel()
-
-    # Add flux intra to incidence df
-    df = df.merge(mob_intra,
-                  left_on=["province", "date"],
-                  right_on=["province origin", "date"]
-                  )
-    df = df.drop(columns='province origin')
-    df = df.rename(columns={'flux': 'flux intra'})
-
-    # Change df to multi index in order to join
-    df.columns = pd.MultiIndex.from_product([df.columns, [""]])
-
-    # Add incidence+flux intra info to province origin in `aux_mob`
-    merged = df.merge(
-        aux_mob,
-        left_on=[("date", ""), ("province", "")],
-        right_on=[("", "date"), ("", "province destination")]
-    )
 
-    merged = merged.drop(columns=[('', 'date'),
-                                  ('', 'province destination')])
-    merged = merged.sort_values(by=['province', 'date'])
-
-    # Order columns
-    cols = [
-        ('date', ''),
-        ('province', ''),
-        ('province id', ''),
-        ('region', ''),
-        ('region id', ''),
-        ('cases new (pcr)', ''),
-        ('cases acc (pcr)', ''),
-        ('cases inc (pcr)', ''),
-        ('incidence 14', ''),
-        ('incidence 7', ''),
-        ('flux intra', ''),
+def compact_dtypes(df):
+    """Return a copy of `df` with compact dtypes for columnar formats."""
+    df = df.copy()
+    for c, t in df.dtypes.items():
+        if pd.api.types.is_integer_dtype(t):
+            df[c] = df[c].astype("int32")
+        elif pd.api.types.is_float_dtype(t):
+            df[c] = df[c].astype("float32")
+        elif pd.api.types.is_object_dtype(t):
+            df[c] = df[c].astype("category")
+    return df
+
+
+def write_dataset(df, name, base_dir, fmt="csv", append=False,
+                  partition_cols=None):
+    """Write a processed dataset as `name` in `fmt` (see `OUTPUT_FORMATS`).
+
+    CSV datasets are a single file. Parquet datasets are a directory, either
+    partitioned by `partition_cols` or with one file per write, named after
+    the last date written, so that appending only adds new files. The
+    directories that end up with more than `PARQUET_MAX_FILES` files are
+    compacted into one, see `compact_parquet`. Parquet has no two-level
+    columns, so those are written flat, see
+    `utils.flatten_columns`.
+    """
+    with instrument.stage(f"write {name}", rows=df.shape[0]):
+        _write_dataset(df, name, base_dir, fmt, append, partition_cols)
+
+
+def _write_dataset(df, name, base_dir, fmt, append, partition_cols):
+    f = base_dir / "processed" / f"{name}.{fmt}"
+
+    if fmt == "csv":
+        df.to_csv(
+            f,
+            mode="a" if append else "w",
+            header=not append,
+            index=False,
+        )
+        return
+
+    if not append and f.exists():
+        shutil.rmtree(f)
+    if df.empty:
+        return
+
+    dates = df.select_dtypes("datetime")
+    tag = f"{dates.max().max():%Y%m%d}" if dates.shape[1] else "part"
+    df = compact_dtypes(df)
+    if isinstance(df.columns, pd.MultiIndex):
+        df = utils.flatten_columns(df)
+    if partition_cols:
+        df.to_parquet(
+            f,
+            index=False,
+            partition_cols=partition_cols,
+            basename_template=f"{tag}-{{i}}.parquet",
+        )
+        written = {i.parent for i in f.rglob(f"{tag}-*.parquet")}
+    else:
+        f.mkdir(exist_ok=True)
+        df.to_parquet(f / f"{tag}.parquet", index=False)
+        written = {f}
+
+    if append:
+        for d in written:
+            compact_parquet(d)
+
+
+def compact_parquet(d):
+    """Merge the files of the Parquet directory `d` into one, named as the
+    last of them, once there are more than `PARQUET_MAX_FILES`.
+
+    The files are named after their last date, so they are merged in date
+    order. The merged file is written under a hidden name first, which
+    readers skip, and renamed once the files it replaces are removed.
+    """
+    files = sorted(d.glob("*.parquet"))
+    if len(files) <= PARQUET_MAX_FILES:
+        return
+
+    df = pd.concat([pd.read_parquet(i) for i in files], ignore_index=True)
+    tmp = d / f".{files[-1].name}"
+    compact_dtypes(df).to_parquet(tmp, index=False)
+    for i in files:
+        i.unlink()
+    tmp.rename(files[-1])
+
+
+def load_state(base_dir, fmt):
+    """Load the state left by the last run, or None if it is not usable."""
+    f = base_dir / "processed" / "provinces-state.json"
+    if not f.exists():
+        return None
+
+    with open(f, "r") as fd:
+        state = json.load(fd)
+
+    outputs = [
+        base_dir / "processed" / f"provinces-incidence.{fmt}",
+        base_dir / "processed" / f"provinces-incidence-mobility.{fmt}",
+        base_dir / "processed" / "province-flux.npy",
+        base_dir / "processed" / "province-flux-index.npz",
     ]
+    if (state.get("version") != STATE_VERSION or
+            state.get("format") != fmt or
+            not all(i.exists() for i in outputs)):
+        return None
 
-    aux = list(set(merged) - set(cols))
-    aux.sort()
-    cols.extend(aux)
-    merged = merged[cols]
+    last = {int(k): v["cases acc (pcr)"]
+            for k, v in state["provinces"].items()}
+    first = {int(k): pd.Timestamp(v["first date"])
+             for k, v in state["provinces"].items()}
 
-    f = base_dir / "processed" / "provinces-incidence-mobility.csv"
-    LOG.info("Writing province +  mobility data + incidence on origin to "
-             f"'{f}', {merged.shape[0]} observations")
-    merged.to_csv(
-        f,
-        index=False,
+    history = pd.DataFrame(
+        [(int(k), d, c)
+         for k, v in state["provinces"].items()
+         for d, c in zip(v["date"], v["cases new (pcr)"])],
+        columns=["province id", "date", "cases new (pcr)"],
     )
+    history["date"] = pd.to_datetime(history["date"], format="%Y-%m-%d")
+    history["cases acc (pcr)"] = history["province id"].map(last)
+
+    pending = pd.DataFrame(state["pending"]["data"],
+                           columns=state["pending"]["columns"])
+    pending["date"] = pd.to_datetime(pending["date"], format="%Y-%m-%d")
+
+    return {
+        "date": pd.Timestamp(state["date"]),
+        "mobility date": pd.Timestamp(state["mobility date"]),
+        "mobility columns": [tuple(c) for c in state["mobility columns"]],
+        "history": history,
+        "pending": pending,
+        "last": last,
+        "first": first,
+    }
+
+
+def save_state(df, merged, mob_date, base_dir, fmt, first=None,
+               pending=None):
+    """Save the per-province state needed to continue incrementally.
+
+    This is the first date, the last accumulated value and the rows of the
+    last days needed to complete the incidence windows of the next dates,
+    together with the columns of the mobility dataset. `first` holds the
+    first dates of a previous state, if `df` does not start at them.
+
+    The processed rows in `pending` after `mob_date`, i.e. not joined with
+    the mobility yet, are also kept, so that the next run can join them
+    without reading the processed datasets.
+    """
+    pending = pending.loc[pending["date"] > mob_date]
+    pending = {
+        "columns": list(pending.columns),
+        "data": pending.assign(
+            date=pending["date"].dt.strftime("%Y-%m-%d")
+        ).astype(object).values.tolist(),
+    }
+
+    df = df.sort_values(by=["province id", "date"])
+    tail = df.loc[
+        df["date"] > df["date"].max() - pd.Timedelta(days=max(WINDOWS) - 1)
+    ]
+    tail = dict(list(tail.groupby("province id")))
+
+    provinces = {}
+    for k, g in df.groupby("province id"):
+        start = g["date"].iloc[0]
+        if first is not None and k in first:
+            start = min(start, first[k])
+        h = tail.get(k, g.iloc[:0])
+        provinces[str(k)] = {
+            "first date": start.strftime("%Y-%m-%d"),
+            "cases acc (pcr)": int(g["cases acc (pcr)"].iloc[-1]),
+            "date": h["date"].dt.strftime("%Y-%m-%d").tolist(),
+            "cases new (pcr)": h["cases new (pcr)"].astype("int").tolist(),
+        }
+
+    state = {
+        "version": STATE_VERSION,
+        "format": fmt,
+        "date": df["date"].max().strftime("%Y-%m-%d"),
+        "mobility date": mob_date.strftime("%Y-%m-%d"),
+        "mobility columns": list(merged.columns),
+        "provinces": provinces,
+        "pending": pending,
+    }
+
+    f = base_dir / "processed" / "provinces-state.json"
+    with open(f, "w") as fd:
+        json.dump(state, fd)
+
+
+def prepare_dataset(base_dir, incremental=False, fmt="csv", jobs=1):
+    state = load_state(base_dir, fmt) if incremental else None
+    if incremental and state is None:
+        LOG.warning("No previous state found, doing a full rebuild")
+
+    if state is not None:
+        prepare_dataset_incremental(base_dir, state, fmt, jobs)
+        return
+
+    df = read_cases(base_dir)
+
+    # Accumulated cases and incidence data
+    df = calculate_provinces_parallel(df, base_dir, jobs=jobs)
+    df = df.sort_values(by=["date", "province"], ignore_index=True)
+
+    LOG.info(f"Writing province data as {fmt}, {df.shape[0]} observations")
+    write_dataset(df, "provinces-incidence", base_dir, fmt,
+                  partition_cols=["province id"])
+
+    with instrument.stage("flux tensor"):
+        flux.write_flux_tensor(lambda: read_flux_chunks(base_dir), base_dir)
+    pending = df.copy()
+    dates, ids, tensor = read_flux_dates(df, base_dir)
+    df = calculate_imported_risk(df, dates, ids, tensor, base_dir)
+    merged = merge_mobility(df, dates, ids, tensor, base_dir)
+
+    LOG.info(f"Writing province +  mobility data + incidence on origin as "
+             f"{fmt}, {merged.shape[0]} observations")
+    write_dataset(merged, "provinces-incidence-mobility", base_dir, fmt)
+
+    # Without fluxes yet, all the dates are joined by the next run
+    mob_date = merged[("date", "")].max()
+    if pd.isna(mob_date):
+        LOG.warning("No mobility data for the province dates")
+        mob_date = df["date"].min() - pd.Timedelta(days=1)
+
+    save_state(df, merged, mob_date, base_dir, fmt, pending=pending)
+    if merged.empty:
+        return
 
     # View data summary
     u, c = np.unique(merged['province'], return_counts=True)
@@ -223,7 +646,75 @@ def prepare_dataset(base_dir):
         print(f"{i}: {j} {'*' if j != med else ''}")
 
 
-def calculate_incidence_cantabria(base_dir):
+def prepare_dataset_incremental(base_dir, state, fmt="csv", jobs=1):
+    """Process only the dates that arrived after the last run.
+
+    The raw history is assumed to be immutable, i.e. already processed dates
+    are not revised. Run a full rebuild if that is not the case.
+    """
+    LOG.info(f"Processing dates after {state['date']:%Y-%m-%d}")
+
+    df = read_cases(base_dir, after=state["date"])
+
+    df = calculate_provinces_parallel(df, base_dir, jobs=jobs,
+                                      last=state["last"],
+                                      history=state["history"],
+                                      first=state["first"])
+    df = df.sort_values(by=["date", "province"], ignore_index=True)
+
+    LOG.info(f"Appending province data as {fmt}, "
+             f"{df.shape[0]} observations")
+    write_dataset(df, "provinces-incidence", base_dir, fmt, append=True,
+                  partition_cols=["province id"])
+
+    # Mobility may lag behind the cases, so take the already processed
+    # incidence of the dates that could not be joined in the last run
+    df_mob = df
+    if not state["pending"].empty:
+        df_mob = pd.concat([state["pending"], df], ignore_index=True)
+    pending = df_mob.copy()
+
+    with instrument.stage("flux tensor"):
+        read_chunks = functools.partial(read_flux_chunks, base_dir)
+        if not flux.append_flux_tensor(read_chunks, base_dir):
+            LOG.warning("New provinces in the fluxes, writing all the flux "
+                        "tensor")
+            flux.write_flux_tensor(read_chunks, base_dir)
+    dates, ids, tensor = read_flux_dates(df_mob, base_dir)
+    df_mob = calculate_imported_risk(df_mob, dates, ids, tensor, base_dir)
+    merged = merge_mobility(df_mob, dates, ids, tensor,
+                            base_dir)
+
+    cols = state["mobility columns"]
+    if set(merged.columns) - set(cols):
+        LOG.warning("New origin provinces in mobility data, "
+                    "doing a full rebuild")
+        prepare_dataset(base_dir, fmt=fmt, jobs=jobs)
+        return
+
+    merged = merged.reindex(columns=pd.MultiIndex.from_tuples(cols))
+    LOG.info(f"Appending province +  mobility data + incidence on origin as "
+             f"{fmt}, {merged.shape[0]} observations")
+    write_dataset(merged, "provinces-incidence-mobility", base_dir, fmt,
+                  append=True)
+
+    mob_date = merged[("date", "")].max()
+    if pd.isna(mob_date):
+        mob_date = state["mobility date"]
+
+    save_state(
+        pd.concat([state["history"], df], ignore_index=True),
+        merged,
+        mob_date,
+        base_dir,
+        fmt,
+        first=state["first"],
+        pending=pending,
+    )
+
+
+def read_snapshot_cantabria(base_dir):
+    """Read the cases of the Cantabria municipalities in the raw snapshot."""
     pob = pd.read_csv(
         base_dir / "external" / "population-cantabria.csv",
         sep=";",
@@ -240,27 +731,306 @@ def calculate_incidence_cantabria(base_dir):
     df = df.drop(columns=['Ano', 'Municipio', 'Metrica'])  # remove useless columns
     # (Ano:census year, Municipio: duplicated with Municio, Metrica: Total census)
     df = df.rename(columns={'Municio': 'Municipio', 'Total': 'Poblacion'})
+    df['Fecha'] = pd.to_datetime(df['Fecha'], format="%d/%m/%Y")
 
     df['incidence rel'] = df['Casos'] / df['Poblacion']
     df['incidence 100k'] = df['Casos'] * 100000 / df['Poblacion']
 
+    return df.drop_duplicates(subset=["Fecha", "Codigo"], keep="last")
+
+
+def calculate_incidence_municipalities(df, history=None, first=None):
+    """Add the new cases and the incidence over the last `WINDOWS` days.
+
+    New cases are the increase of the accumulated cases since the previous
+    date of each municipality, none on its first date, whose windows are
+    left out. `history` holds the dates already processed, with their new
+    cases, and `first` maps municipalities to their first date, if
+    `history` does not start at it.
+    """
+    cols = ["Fecha", "Codigo", "Casos"]
+    cases = df[cols].assign(new=True)
+    if history is not None:
+        cases = pd.concat(
+            [history[cols + ["Casos nuevos"]].assign(new=False), cases],
+            ignore_index=True,
+        )
+    cases = cases.sort_values(by=["Codigo", "Fecha"])
+
+    prev = cases.groupby("Codigo")["Casos"].shift()
+    new_cases = (cases["Casos"] - prev).fillna(0)
+    if history is not None:
+        new_cases = new_cases.where(cases["new"], cases["Casos nuevos"])
+    new_cases = new_cases.astype("int")
+    cases["Casos nuevos"] = new_cases
+
+    start = cases.groupby("Codigo")["Fecha"].min()
+    if first is not None:
+        known = pd.Series(first, dtype="datetime64[ns]").reindex(start.index)
+        start = known.where(known < start, start)
+    first = start + pd.Timedelta(days=1)
+    sums = utils.window_sums(cases, "Codigo", "Casos nuevos", WINDOWS,
+                             first=first.to_dict(), date="Fecha")
+
+    # Back to the order of `df`
+    order = np.argsort(cases.index.values[cases["new"].values])
+    df["Casos nuevos"] = new_cases.values[cases["new"].values][order]
+    for w in WINDOWS:
+        aux = sums[w][cases["new"].values][order]
+        df[f"incidence {w}"] = aux * 100000 / df["Poblacion"].values
+
+    return df
+
+
+def snapshot_cantabria(df, fmt="csv"):
+    """Cases of the municipalities on the last date, for the map.
+
+    Dates are written as day/month/year in CSV, and kept as dates in
+    Parquet.
+    """
+    df = df.loc[df["Fecha"] == df["Fecha"].max()].reset_index(drop=True)
+
     # Add NaN data for the Macomunidad de Cabuerniga
     # We use zeros because Mapbox doesn't plot NaN/None data
     cabuer = pd.DataFrame(np.zeros_like(df[0:1]), columns=df.columns)
     k = ['Fecha', 'Codigo', 'Municipio']
-    v = df.loc[0, 'Fecha'], 39000, 'Comunidad Campoo-Cabuerniga'
-    cabuer.at[0, k] = v
-    df = pd.concat([cabuer, df], axis=0, ignore_index=True)
+    v = df.loc[0, 'Fecha'], "39000", 'Comunidad Campoo-Cabuerniga'
+    cabuer.loc[0, k] = v
+    df = pd.concat([cabuer, df], axis=0, ignore_index=True).infer_objects()
 
-    f = base_dir / "processed" / "cantabria-incidence.csv"
-    df.to_csv(
-        f,
-        index=False)
+    if fmt == "csv":
+        df["Fecha"] = df["Fecha"].dt.strftime("%d/%m/%Y")
+    return df
+
+
+def load_state_cantabria(base_dir, fmt):
+    """Load the Cantabria state left by the last run, or None if it is not
+    usable."""
+    f = base_dir / "processed" / "cantabria-state.json"
+    if not f.exists():
+        return None
+
+    with open(f, "r") as fd:
+        state = json.load(fd)
+
+    outputs = [
+        base_dir / "processed" / f"cantabria-history.{fmt}",
+        base_dir / "processed" / f"cantabria-incidence.{fmt}",
+    ]
+    if (state.get("version") != STATE_VERSION or
+            state.get("format") != fmt or
+            not all(i.exists() for i in outputs)):
+        return None
+
+    rows = pd.DataFrame(
+        [(k, d, c, n)
+         for k, v in state["municipalities"].items()
+         for d, c, n in zip(v["date"], v["Casos"], v["Casos nuevos"])],
+        columns=["Codigo", "Fecha", "Casos", "Casos nuevos"],
+    )
+    rows["Fecha"] = pd.to_datetime(rows["Fecha"], format="%Y-%m-%d")
+
+    return {
+        "date": pd.Timestamp(state["date"]),
+        "first": {k: pd.Timestamp(v["first date"])
+                  for k, v in state["municipalities"].items()},
+        "history": rows,
+    }
+
+
+def save_state_cantabria(df, base_dir, fmt, first=None):
+    """Save the per-municipality state needed to continue incrementally.
+
+    This is the first date and the rows of the last days needed to complete
+    the incidence windows of the next dates, together with the last row of
+    each municipality, whose cases the next ones are counted from. `first`
+    holds the first dates of a previous state, if `df` does not start at
+    them.
+    """
+    df = df[["Fecha", "Codigo", "Casos", "Casos nuevos"]].sort_values(
+        by=["Codigo", "Fecha"])
+    tail = df["Fecha"] > df["Fecha"].max() - pd.Timedelta(
+        days=max(WINDOWS) - 1)
+    tail |= ~df["Codigo"].duplicated(keep="last")
+
+    municipalities = {}
+    for k, g in df.groupby("Codigo"):
+        start = g["Fecha"].iloc[0]
+        if first is not None and k in first:
+            start = min(start, first[k])
+        h = g.loc[tail[g.index]]
+        municipalities[k] = {
+            "first date": start.strftime("%Y-%m-%d"),
+            "date": h["Fecha"].dt.strftime("%Y-%m-%d").tolist(),
+            "Casos": h["Casos"].astype("int").tolist(),
+            "Casos nuevos": h["Casos nuevos"].astype("int").tolist(),
+        }
+
+    state = {
+        "version": STATE_VERSION,
+        "format": fmt,
+        "date": df["Fecha"].max().strftime("%Y-%m-%d"),
+        "municipalities": municipalities,
+    }
+
+    f = base_dir / "processed" / "cantabria-state.json"
+    with open(f, "w") as fd:
+        json.dump(state, fd)
+
+
+def drop_known_cantabria(df, state, base_dir, fmt):
+    """Drop the rows of the snapshot already in the history.
+
+    Only the history of the dates of the snapshot up to the last run is
+    read, and only if there are any.
+    """
+    old = df["Fecha"] <= state["date"]
+    if not old.any():
+        return df
+
+    known = utils.read_processed(
+        base_dir, "cantabria-history", fmt, columns=["Fecha", "Codigo"],
+        after=df.loc[old, "Fecha"].min() - pd.Timedelta(days=1),
+        date="Fecha",
+    )
+    known = pd.MultiIndex.from_frame(known[["Fecha", "Codigo"]])
+    return df.loc[~pd.MultiIndex.from_frame(
+        df[["Fecha", "Codigo"]]).isin(known)]
+
+
+def rewrite_cantabria(df, base_dir, fmt):
+    """New cases and incidence of the whole history with the snapshot rows
+    `df` not in it yet."""
+    history = utils.read_processed(base_dir, "cantabria-history", fmt,
+                                   date="Fecha")
+    if history is not None:
+        df = pd.concat([history[df.columns], df], ignore_index=True)
+        df = df.drop_duplicates(subset=["Fecha", "Codigo"], keep="first")
+    return calculate_incidence_municipalities(df.reset_index(drop=True))
+
+
+def calculate_incidence_cantabria(base_dir, fmt="csv"):
+    """Add the raw snapshot of the Cantabria municipalities to their history.
+
+    The dates of the snapshot not in the history yet are appended to it,
+    from the last days of the history kept in `cantabria-state.json`,
+    unless they are older than its last date, in which case the history is
+    rewritten in order. The last date is also written on its own, for the
+    map.
+    """
+    with instrument.stage("cantabria") as record:
+        df = read_snapshot_cantabria(base_dir)
+        state = load_state_cantabria(base_dir, fmt)
+
+        append = False
+        if state is not None:
+            df = drop_known_cantabria(df, state, base_dir, fmt)
+            append = df.empty or df["Fecha"].min() > state["date"]
+
+        if append:
+            df = calculate_incidence_municipalities(df, state["history"],
+                                                    first=state["first"])
+        else:
+            if state is not None:
+                LOG.warning("Snapshot older than the Cantabria history, "
+                            "rewriting it")
+            df = rewrite_cantabria(df, base_dir, fmt)
+        df = df.sort_values(by=["Fecha", "Codigo"], ignore_index=True)
+        record["rows"] = df.shape[0]
+
+    if append and df.empty:
+        LOG.info("No new dates in the Cantabria snapshot")
+        return
+    if df.empty:
+        LOG.warning("No Cantabria data, skipping its datasets")
+        return
+
+    LOG.info(f"{'Appending' if append else 'Writing'} Cantabria history as "
+             f"{fmt}, {df.shape[0]} observations")
+    write_dataset(df, "cantabria-history", base_dir, fmt, append=append)
+    write_dataset(snapshot_cantabria(df, fmt), "cantabria-incidence",
+                  base_dir, fmt)
+
+    if append:
+        save_state_cantabria(
+            pd.concat([state["history"], df], ignore_index=True),
+            base_dir, fmt, first=state["first"],
+        )
+    else:
+        save_state_cantabria(df, base_dir, fmt)
+
+
+def file_hash(path, blocksize=1 << 20):
+    """SHA-256 of the contents of `path`, read in blocks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while block := fd.read(blocksize):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_stage_cache(base_dir):
+    f = base_dir / "processed" / "stages.json"
+    if not f.exists():
+        return {}
+    with open(f, "r") as fd:
+        return json.load(fd)
+
+
+def save_stage_cache(cache, base_dir):
+    f = base_dir / "processed" / "stages.json"
+    with open(f, "w") as fd:
+        json.dump(cache, fd, indent=2, sort_keys=True)
+
+
+def run_stage(base_dir, stage, run, force=False, **params):
+    """Call `run` unless the stage is up to date.
+
+    A stage is up to date when the hashes of its inputs and the `params`
+    it depends on are those recorded after its last run, and its outputs
+    exist. They are recorded in `processed/stages.json` once `run` ends.
+    """
+    signature = {
+        "inputs": {f: file_hash(base_dir / f)
+                   for f in STAGES[stage]["inputs"]},
+        "params": params,
+    }
+    outputs = [base_dir / "processed" / f.format(**params)
+               for f in STAGES[stage]["outputs"]]
+
+    cache = load_stage_cache(base_dir)
+    if (not force and cache.get(stage) == signature and
+            all(f.exists() for f in outputs)):
+        LOG.info(f"Skipping stage '{stage}', its inputs did not change")
+        return
+
+    LOG.info(f"Running stage '{stage}'")
+    with instrument.stage(f"stage {stage}"):
+        run()
+
+    cache = load_stage_cache(base_dir)
+    cache[stage] = signature
+    save_stage_cache(cache, base_dir)
 
 
 @click.command()
 @click.argument('base_dir', type=click.Path(exists=True))
-def main(base_dir):
+@click.option('--incremental', is_flag=True,
+              help="Only process the dates that arrived since the last run.")
+@click.option('--format', 'fmt', type=click.Choice(OUTPUT_FORMATS),
+              default="csv", show_default=True,
+              help="Format of the processed datasets.")
+@click.option('--jobs', type=int, default=1, show_default=True,
+              help="Processes for the per-province computations "
+                   "(-1 for all the CPUs).")
+@click.option('--force', is_flag=True,
+              help="Run all the stages, even if their inputs did not change.")
+@click.option('--report-dir', type=click.Path(file_okay=False),
+              default=REPORT_DIR, show_default=True,
+              help="Directory of the run report with the stage timings.")
+@click.option('--log-report', is_flag=True,
+              help="Also log the stage timings.")
+def main(base_dir, incremental, fmt, jobs, force, report_dir, log_report):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
@@ -269,9 +1039,34 @@ def main(base_dir):
     base_dir = pathlib.Path(base_dir)
     check_data(base_dir)
 
-    prepare_dataset(base_dir)
+    try:
+        run_stage(
+            base_dir,
+            "provinces",
+            lambda: prepare_dataset(base_dir, incremental=incremental,
+                                    fmt=fmt, jobs=jobs),
+            force=force,
+            fmt=fmt,
+        )
+
+        run_stage(
+            base_dir,
+            "cantabria",
+            lambda: calculate_incidence_cantabria(base_dir, fmt=fmt),
+            force=force,
+            fmt=fmt,
+        )
 
-    calculate_incidence_cantabria(base_dir)
+        run_stage(
+            base_dir,
+            "adjacency",
+            lambda: adjacency.write_adjacency(base_dir),
+            force=force,
+        )
+    finally:
+        # Also report the stages that ran when one fails
+        instrument.write_report(pathlib.Path(report_dir),
+                                logger=LOG if log_report else None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,323 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import logging
+import math
+import pathlib
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import numpy as np
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+FILES = [
+    "external/municipios-cantabria.geojson",
+    "external/provincias-espana.geojson",
+]
+
+# Map zoom levels for which a simplified geometry is produced
+ZOOMS = (5, 7, 9)
+
+# Grid (in degrees) on which the original coordinates are snapped, so that
+# the vertices shared by neighbouring polygons are exactly equal
+QUANTUM = 1e-6
+
+
+def pixel_size(zoom):
+    """Size in degrees of a screen pixel at the given map zoom."""
+    return 360 / (256 * 2 ** zoom)
+
+
+def douglas_peucker(points, tolerance):
+    """Mask of the points kept by the Douglas-Peucker simplification."""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+
+        a, b = points[i], points[j]
+        seg = points[i + 1:j]
+        d = b - a
+        norm = np.hypot(*d)
+        if norm == 0:
+            dist = np.hypot(*(seg - a).T)
+        else:
+            dist = np.abs(
+                d[0] * (seg[:, 1] - a[1]) - d[1] * (seg[:, 0] - a[0])
+            ) / norm
+
+        k = np.argmax(dist)
+        if dist[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.extend([(i, k), (k, j)])
+
+    return keep
+
+
+def polygons(geometry):
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    return geometry["coordinates"]
+
+
+class Topology:
+    """Polygon rings split into the arcs shared between neighbours.
+
+    Rings are cut at the junctions, i.e. the vertices where the set of rings
+    sharing a boundary changes. Each arc is stored once, in a canonical
+    direction, so that it is simplified in the same way for all the polygons
+    it bounds and no gaps or overlaps appear between them.
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self.arcs = []
+        self._index = {}
+
+        rings = [
+            [tuple(np.round(np.array(p) / QUANTUM).astype(int)) for p in r]
+            for f in features
+            for poly in polygons(f["geometry"])
+            for r in poly
+        ]
+        # Drop the closing point, rings are handled cyclically
+        rings = [r[:-1] if r[0] == r[-1] else r for r in rings]
+
+        owners = collections.defaultdict(set)
+        for n, r in enumerate(rings):
+            for p in r:
+                owners[p].add(n)
+
+        refs = iter([self._split(r, owners) for r in rings])
+        self.geometries = [
+            [[next(refs) for _ in poly] for poly in polygons(f["geometry"])]
+            for f in features
+        ]
+
+    def _add(self, arc):
+        rev = arc[::-1]
+        key, reverse = (arc, False) if arc <= rev else (rev, True)
+        if key not in self._index:
+            self._index[key] = len(self.arcs)
+            self.arcs.append(np.array(key))
+        i = self._index[key]
+        return ~i if reverse else i
+
+    def _split(self, ring, owners):
+        n = len(ring)
+        junctions = [
+            i for i in range(n)
+            if owners[ring[i]] != owners[ring[i - 1]] or
+            owners[ring[i]] != owners[ring[(i + 1) % n]]
+        ]
+
+        if not junctions:
+            # Closed ring without neighbour changes (islands, enclaves):
+            # start it at its lowest point and cut it at the farthest one
+            i = ring.index(min(ring))
+            ring = ring[i:] + ring[:i]
+            rev = ring[:1] + ring[:0:-1]
+            ring = min(ring, rev)
+            pts = np.array(ring, dtype=float)
+            k = int(np.argmax(np.hypot(*(pts - pts[0]).T)))
+            junctions = [0, k] if k else [0]
+
+        ring = ring[junctions[0]:] + ring[:junctions[0]]
+        cuts = [j - junctions[0] for j in junctions] + [n]
+        return [
+            self._add(tuple(ring[a:b + 1] if b < n else ring[a:] + ring[:1]))
+            for a, b in zip(cuts[:-1], cuts[1:])
+        ]
+
+    def simplify(self, tolerance, decimals):
+        """Simplified arcs, snapped to the grid given by `decimals`."""
+        arcs = []
+        for arc in self.arcs:
+            pts = arc * QUANTUM
+            pts = np.round(pts[douglas_peucker(pts, tolerance)], decimals)
+            # Remove the repeated points left by the snapping
+            dup = np.r_[False, (np.diff(pts, axis=0) == 0).all(axis=1)]
+            dup[-1] = False
+            arcs.append(pts[~dup])
+        return arcs
+
+    def resolve(self, arcs, decimals):
+        """Arcs and arc references of each feature for the simplified arcs.
+
+        The rings that the simplification collapses to fewer than 3 points
+        reference instead a new arc with their original points, snapped to
+        the grid given by `decimals`, so that small rings (islands, enclaves)
+        are kept in every output format. Rings smaller than the grid cell are
+        dropped, with their polygon if they are its exterior ring.
+        """
+        arcs = list(arcs)
+        geometries = []
+        for feature, geometry in zip(self.features, self.geometries):
+            result = []
+            for poly, poly_refs in zip(polygons(feature["geometry"]),
+                                       geometry):
+                rings = []
+                for r, refs in zip(poly, poly_refs):
+                    if len(np.unique(join(arcs, refs), axis=0)) < 3:
+                        # Do not collapse small rings
+                        refs = snap_ring(arcs, r, decimals)
+                    if refs:
+                        rings.append(refs)
+                    elif not rings:
+                        break
+                if rings:
+                    result.append(rings)
+            geometries.append(result)
+        return arcs, geometries
+
+    def rings(self, arcs, decimals):
+        """Rebuild the polygons of each feature from the given arcs."""
+        arcs, geometries = self.resolve(arcs, decimals)
+        for feature, geometry in zip(self.features, geometries):
+            result = []
+            for poly_refs in geometry:
+                rings = []
+                for refs in poly_refs:
+                    ring = join(arcs, refs)
+                    rings.append(np.vstack([ring, ring[:1]]).tolist())
+                result.append(rings)
+            yield feature, result
+
+
+def join(arcs, refs):
+    """Points of the ring made of the referenced arcs, without closing it."""
+    return np.concatenate([
+        arcs[i][:-1] if i >= 0 else arcs[~i][:0:-1]
+        for i in refs
+    ])
+
+
+def snap_ring(arcs, ring, decimals):
+    """Add `ring` snapped to the grid given by `decimals` as a new arc.
+
+    Returns the reference to it, or None if fewer than 3 points are left.
+    """
+    pts = np.round(np.array(ring), decimals)
+    pts = pts[np.r_[True, (np.diff(pts, axis=0) != 0).any(axis=1)]]
+    if len(np.unique(pts, axis=0)) < 3:
+        return None
+    if (pts[0] != pts[-1]).any():
+        pts = np.vstack([pts, pts[:1]])
+    arcs.append(pts)
+    return [len(arcs) - 1]
+
+
+def to_geojson(topology, arcs, decimals):
+    features = []
+    for feature, coords in topology.rings(arcs, decimals):
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            coords = coords[0] if coords else []
+        features.append({
+            **feature,
+            "geometry": {"type": geometry["type"], "coordinates": coords},
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def to_topojson(topology, arcs, name, decimals):
+    """Encode the arcs as a quantized, delta-encoded TopoJSON topology."""
+    arcs, feature_refs = topology.resolve(arcs, decimals)
+    scale = 10 ** -decimals
+    origin = np.min([a.min(axis=0) for a in arcs], axis=0)
+
+    encoded = []
+    for arc in arcs:
+        q = np.round((arc - origin) / scale).astype(int)
+        encoded.append(np.vstack([q[:1], np.diff(q, axis=0)]).tolist())
+
+    geometries = []
+    for feature, refs in zip(topology.features, feature_refs):
+        if feature["geometry"]["type"] == "Polygon":
+            refs = refs[0] if refs else []
+        geometry = {"type": feature["geometry"]["type"], "arcs": refs}
+        geometry["properties"] = feature.get("properties", {})
+        if "id" in feature:
+            geometry["id"] = feature["id"]
+        geometries.append(geometry)
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": [scale, scale], "translate": origin.tolist()},
+        "objects": {
+            name: {"type": "GeometryCollection", "geometries": geometries},
+        },
+        "arcs": encoded,
+    }
+
+
+def simplify_geometry(path, base_dir, topojson=False):
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    topology = Topology(data["features"])
+
+    for zoom in ZOOMS:
+        tolerance = pixel_size(zoom) / 2
+        decimals = math.ceil(-math.log10(tolerance / 10))
+        arcs = topology.simplify(tolerance, decimals)
+
+        f = base_dir / "processed" / f"{path.stem}-z{zoom}.geojson"
+        LOG.info(f"Writing geometry for zoom {zoom} to '{f}', "
+                 f"{sum(len(a) for a in arcs)} points")
+        with open(f, "w") as fd:
+            json.dump(to_geojson(topology, arcs, decimals), fd,
+                      separators=(",", ":"))
+
+        if topojson:
+            with open(f.with_suffix(".topojson"), "w") as fd:
+                json.dump(to_topojson(topology, arcs, path.stem, decimals),
+                          fd, separators=(",", ":"))
+
+
+@click.command()
+@click.argument('base_dir', type=click.Path(exists=True))
+@click.option('--topojson', is_flag=True,
+              help="Also write the geometries as TopoJSON.")
+def main(base_dir, topojson):
+    """ Simplifies the boundaries in (../external) for each map zoom level
+        in `ZOOMS` (saved in ../processed).
+    """
+    base_dir = pathlib.Path(base_dir)
+
+    for f in FILES:
+        simplify_geometry(base_dir / f, base_dir, topojson=topojson)
+
+
+if __name__ == '__main__':
+
+    # not used in this stub but often useful for finding various files
+    project_dir = pathlib.Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,174 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthetic raw data with the schemas of the files in `make_dataset.FILES`.
+
+The static files in `external` are copied from the project data, and the
+raw cases, municipal cases and fluxes are generated at random for the
+requested number of days, provinces and flux density.
+"""
+
+import logging
+import pathlib
+import shutil
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import numpy as np
+import pandas as pd
+
+import utils
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+PROJECT_DIR = pathlib.Path(__file__).resolve().parents[2]
+EXTERNAL_DIR = PROJECT_DIR / "data" / "external"
+
+CASES_COLUMNS = [
+    "provincia_iso",
+    "fecha",
+    "num_casos",
+    "num_casos_prueba_pcr",
+    "num_casos_prueba_test_ac",
+    "num_casos_prueba_ag",
+    "num_casos_prueba_elisa",
+    "num_casos_prueba_desconocida",
+]
+
+
+def provinces(n=None):
+    """ISO codes, ids and names of the first `n` provinces (all by default).
+
+    Navarra is reported with the 'NC' code, as in the raw cases.
+    """
+    prov = pd.read_csv(EXTERNAL_DIR / "provincias-ine.csv", sep=";")
+    isos = pd.DataFrame({
+        "iso": [k for k in utils.iso_map if k != "NC"],
+        "provincia": [v for k, v in utils.iso_map.items() if k != "NC"],
+    })
+    df = isos.merge(prov[["id provincia", "provincia"]], on="provincia")
+    df["iso"] = df["iso"].replace("NA", "NC")
+    return df.iloc[:n].reset_index(drop=True)
+
+
+def generate_cases(prov, dates, rng):
+    n = len(prov) * len(dates)
+    df = pd.DataFrame({
+        "provincia_iso": np.repeat(prov["iso"].values, len(dates)),
+        "fecha": np.tile(dates.strftime("%Y-%m-%d"), len(prov)),
+    })
+    for c in CASES_COLUMNS[2:]:
+        df[c] = rng.poisson(20, n)
+    return df
+
+
+def generate_flux(prov, dates, density, rng):
+    """Fluxes between a random fraction `density` of the province pairs.
+
+    Fluxes within a province are always present.
+    """
+    p = len(prov)
+    t, o, d = np.meshgrid(np.arange(len(dates)), np.arange(p), np.arange(p),
+                          indexing="ij")
+    t, o, d = t.ravel(), o.ravel(), d.ravel()
+    keep = (o == d) | (rng.random(len(t)) < density)
+    t, o, d = t[keep], o[keep], d[keep]
+
+    ids = prov["id provincia"].values
+    names = prov["provincia"].values
+    return pd.DataFrame({
+        "date": dates.strftime("%Y-%m-%d")[t],
+        "province id origin": ids[o],
+        "province origin": names[o],
+        "province id destination": ids[d],
+        "province destination": names[d],
+        "flux": rng.integers(0, 10000, len(t)).astype("float"),
+    })
+
+
+def generate_municipalities(date, rng):
+    """Cases of the Cantabria municipalities, a snapshot at `date`."""
+    pob = pd.read_csv(
+        EXTERNAL_DIR / "population-cantabria.csv",
+        sep=";",
+        dtype={"Codigo": str},
+    )
+    n = len(pob)
+    return pd.DataFrame({
+        "Fecha": date.strftime("%d/%m/%Y"),
+        "Codigo": pob["Codigo"],
+        "Municipio": pob["Municio"],
+        "Casos": rng.integers(0, 100, n),
+        "Activos": rng.integers(0, 50, n),
+        "Curados": rng.integers(0, 50, n),
+        "Fallecidos": rng.integers(0, 5, n),
+    })
+
+
+def generate(base_dir, days=60, n_provinces=None, density=1.0,
+             start="2020-03-01", seed=0):
+    """Write synthetic raw data to `base_dir`, in the `make_dataset` layout."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=days)
+    prov = provinces(n_provinces)
+
+    for d in ["raw", "processed"]:
+        (base_dir / d).mkdir(parents=True, exist_ok=True)
+    shutil.copytree(EXTERNAL_DIR, base_dir / "external", dirs_exist_ok=True)
+
+    generate_cases(prov, dates, rng).to_csv(
+        base_dir / "raw" / "casos_tecnica_provincias.csv",
+        index=False,
+    )
+    mob = generate_flux(prov, dates, density, rng)
+    mob.to_csv(base_dir / "raw" / "province_flux.csv", index=False)
+    generate_municipalities(dates[-1], rng).to_csv(
+        base_dir / "raw" / "COVID19_municipalizado.csv",
+        sep=";",
+        index=False,
+    )
+
+    LOG.info(f"Generated {days} days of {len(prov)} provinces, "
+             f"{mob.shape[0]} fluxes in '{base_dir}'")
+
+
+@click.command()
+@click.argument('base_dir', type=click.Path(file_okay=False))
+@click.option('--days', type=int, default=60, show_default=True)
+@click.option('--provinces', 'n_provinces', type=int, default=None,
+              help="Number of provinces [default: all]")
+@click.option('--density', type=float, default=1.0, show_default=True,
+              help="Fraction of the province pairs with fluxes.")
+@click.option('--seed', type=int, default=0, show_default=True)
+def main(base_dir, days, n_provinces, density, seed):
+    """ Generates synthetic raw data in BASE_DIR, to run or benchmark the
+        pipeline without downloading the real data.
+    """
+    generate(pathlib.Path(base_dir), days=days, n_provinces=n_provinces,
+             density=density, seed=seed)
+
+
+if __name__ == '__main__':
+
+    # not used in this stub but often useful for finding various files
+    project_dir = pathlib.Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as np
+import pandas as pd
+
 iso_map = {
     "C": "Coruña, A",
     "VI": "Araba/Álava",
@@ -69,25 +72,178 @@ iso_map = {
     "Z": "Zaragoza",
 }
 
+# Separator of the origin province and the metric in the flat Parquet column
+# names of the mobility dataset, e.g. "Cantabria|incidence 7"
+COLUMN_SEP = "|"
+
+# Format of the dates of the processed CSV datasets, where it is not ISO
+CSV_DATE_FORMATS = {"cantabria-incidence": "%d/%m/%Y"}
+
+
+def read_population(base_dir):
+    """Population of each province in 2019, from `external`."""
+    df = pd.read_csv(
+        base_dir / "external" / "province-population.csv",
+        sep=";"
+    )
+    df = df.loc[
+        (df["Sexo"] == "Total") &
+        (df["Provincias"] != "Total") &
+        (df["Periodo"] == 2019)
+    ]
+    df["province id"] = df["Provincias"].apply(lambda x: int(x.split()[0]))
+    df["Total"] = df["Total"].apply(lambda x: int(x.replace(".", "")))
+    df = df[["province id", "Total"]]
+
+    return df
+
+
+def province_names(base_dir):
+    """Name of each province id, as `add_province_info` gives it to the
+    cases."""
+    df = pd.read_csv(base_dir / "external" / "provincias-ine.csv", sep=";")
+    df = df.loc[df["provincia"].isin(set(iso_map.values()))]
+    return df.drop_duplicates("id provincia").set_index("id provincia")[
+        "provincia"]
+
 
 def add_province_info(df_orig, df_prov):
-    df_orig.insert(1, "province id", 0)
-    df_orig.insert(2, "province", 0)
-    df_orig.insert(3, "region id", 0)
-    df_orig.insert(4, "region", 0)
-
-    # Homogenize codes, names, etc. using INE data
-    df_orig["province"] = df_orig["province iso"].apply(iso_map.get)
-
-    for p in df_orig["province"].unique():
-        # print("-", p)
-        df_orig.loc[
-            df_orig["province"] == p,
-            ("province id", "region", "region id")
-        ] = (
-            df_prov.loc[df_prov["provincia"] == p][
-                ["id provincia", "autonomia", "id auto"]
-            ].values[0]
+    """Replace the province ISO codes with the INE province and region info.
+
+    The lookup table is built once for the ISO codes present in `df_orig` and
+    taken by their categorical codes, so that `df_orig` is scanned only once.
+    """
+    iso = pd.Categorical(df_orig["province iso"])
+
+    table = pd.DataFrame(
+        {"province": [iso_map.get(i) for i in iso.categories]},
+        index=iso.categories,
+    )
+    table = table.join(
+        df_prov.drop_duplicates("provincia").set_index("provincia")[
+            ["id provincia", "id auto", "autonomia"]
+        ],
+        on="province",
+    )
+
+    unknown = table.loc[table["id provincia"].isna()]
+    if not unknown.empty:
+        raise ValueError(
+            "Unknown provinces (ISO code: name): " +
+            ", ".join(f"{k}: {v}" for k, v in unknown["province"].items())
         )
 
+    codes = iso.codes
+    df_orig.insert(1, "province id",
+                   table["id provincia"].astype("int").values[codes])
+    df_orig.insert(2, "province", table["province"].values[codes])
+    df_orig.insert(3, "region id",
+                   table["id auto"].astype("int").values[codes])
+    df_orig.insert(4, "region", table["autonomia"].values[codes])
+
     del df_orig['province iso']
+
+
+def window_sums(df, key, column, windows, first=None, date="date"):
+    """Sums of `column` over the last `w` days, for each row and window.
+
+    Rows are laid out in a dense `key` x day array, with the days missing in
+    between filled with zeros, and each window sum is the difference of two
+    cumulative sums along the days. Windows starting before the first date
+    of their `key` (taken from `first`, a mapping of key to date, if given)
+    are NaN. Returns a dict with an array aligned with `df` for each window.
+    """
+    keys, k = np.unique(df[key].values, return_inverse=True)
+    days = pd.to_datetime(df[date]).values.astype("datetime64[D]")
+    if not len(days):
+        return {w: np.zeros(0) for w in windows}
+
+    start = days.min()
+    t = (days - start).astype("int")
+
+    acc = np.zeros((len(keys), t.max() + 2))
+    acc[k, t + 1] = df[column].values
+    acc = acc.cumsum(axis=1)
+
+    first_t = np.full(len(keys), t.max())
+    np.minimum.at(first_t, k, t)
+    if first is not None:
+        known = pd.to_datetime(pd.Series(keys).map(first))
+        known = (known.values.astype("datetime64[D]") - start).astype("int")
+        first_t = np.where(pd.Series(keys).isin(first), known, first_t)
+
+    sums = {}
+    for w in windows:
+        s = acc[k, t + 1] - acc[k, np.maximum(t + 1 - w, 0)]
+        s[t - first_t[k] < w - 1] = np.nan
+        sums[w] = s
+    return sums
+
+
+def flatten_columns(df):
+    """Two-level columns as "origin|metric" names, bare names without metric.
+    """
+    df = df.copy(deep=False)
+    df.columns = [f"{a}{COLUMN_SEP}{b}" if b else a for a, b in df.columns]
+    return df
+
+
+def restore_columns(df):
+    """Two-level columns from those of `flatten_columns`, or those read from
+    a CSV two-row header."""
+    columns = []
+    for c in df.columns:
+        if isinstance(c, tuple):
+            a, b = c
+            b = "" if b.startswith("Unnamed:") else b
+        else:
+            a, _, b = c.partition(COLUMN_SEP)
+        columns.append((a, b))
+    df.columns = pd.MultiIndex.from_tuples(columns)
+    return df
+
+
+def processed_path(base_dir, name, fmt=None):
+    """Path of the processed dataset `name` in `fmt`, by default Parquet if
+    it exists and CSV otherwise."""
+    f = base_dir / "processed" / f"{name}.parquet"
+    if fmt is None:
+        fmt = "parquet" if f.exists() else "csv"
+    return base_dir / "processed" / f"{name}.{fmt}"
+
+
+def read_processed(base_dir, name, fmt=None, columns=None, after=None,
+                   date="date", levels=1):
+    """Read the processed dataset `name`, or None if it does not exist.
+
+    The dataset is read in `fmt`, see `processed_path`, and both formats give
+    the same frame: the `date` column is parsed, Parquet categories are read
+    as their values and integers as `int`, and municipality codes as
+    strings. Only `columns` are read, if given, and the rows whose `date` is
+    after `after`. Datasets with two `levels` of columns are read with them
+    restored, see `restore_columns`, e.g. ("date", "").
+    """
+    f = processed_path(base_dir, name, fmt)
+    if not f.exists():
+        return None
+
+    if f.suffix == ".csv":
+        df = pd.read_csv(f, header=0 if levels == 1 else [0, 1],
+                         usecols=columns, dtype={"Codigo": str},
+                         float_precision="round_trip")
+    else:
+        filters = [(date, ">", after)] if after is not None else None
+        df = pd.read_parquet(f, columns=columns, filters=filters)
+        for c in df.select_dtypes("category"):
+            df[c] = df[c].astype(df[c].cat.categories.dtype)
+        for c in df.select_dtypes("integer"):
+            df[c] = df[c].astype("int")
+
+    if levels == 2:
+        df = restore_columns(df)
+        date = (date, "")
+    if date in df:
+        df[date] = pd.to_datetime(df[date], format=CSV_DATE_FORMATS.get(name))
+        if after is not None:
+            df = df.loc[df[date] > after]
+    return df
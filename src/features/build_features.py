@@ -0,0 +1,306 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Supervised design matrix of the province incidence.
+
+The features of all the provinces and dates are built at once, as a
+provinces x dates x features float32 array. The features of a date only use
+data up to the day before, so they can be used to predict the target on it:
+
+- the target on each of the last `LAGS` days,
+- its mean over the last `ROLLING` days,
+- the target of the origins of the trips into the province the day before,
+  weighted by the fluxes,
+- the mean target of the neighbouring provinces the day before.
+
+The array is stored as a `.npy` file in `processed`, together with the
+dates, province ids and feature names indexing it, and the target. The
+incidence of the neighbours of each Cantabria municipality on each date is
+also written, from the municipality adjacency.
+"""
+
+import logging
+import pathlib
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import numpy as np
+import pandas as pd
+
+from src.data import adjacency, flux, utils
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+# Series to predict, from `provinces-incidence`
+TARGET = "incidence 7"
+
+# Days of the target used as features
+LAGS = 14
+
+# Days over which the target is averaged
+ROLLING = (7, 14, 28)
+
+
+def province_array(df, column, dates, ids):
+    """Dates x provinces array of `column`, NaN where there is no data."""
+    values = np.full((len(dates), len(ids)), np.nan, dtype="float32")
+    t, p, ok = flux.positions(df, dates, ids)
+    values[t[ok], p[ok]] = df[column].values[ok]
+    return values
+
+
+def lags(values, k):
+    """Values of the last `k` days before each date, NaN before the first.
+
+    Returns a dates x provinces x `k` array, the last axis being the lag.
+    """
+    padded = np.concatenate([
+        np.full((k, values.shape[1]), np.nan, dtype=values.dtype),
+        values,
+    ])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, k, axis=0)
+    return windows[:values.shape[0], :, ::-1]
+
+
+def rolling_means(values, windows):
+    """Means over the days before each date, NaN unless the window is full.
+
+    Returns a dates x provinces x windows array.
+    """
+    ok = np.isfinite(values)
+    acc = np.zeros((values.shape[0] + 1,) + values.shape[1:])
+    acc[1:] = np.cumsum(np.where(ok, values, 0), axis=0)
+    count = np.zeros(acc.shape)
+    count[1:] = np.cumsum(ok, axis=0)
+
+    t = np.arange(values.shape[0])
+    means = []
+    for w in windows:
+        start = np.maximum(t - w, 0)
+        n = count[t] - count[start]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            m = (acc[t] - acc[start]) / n
+        m[n < w] = np.nan
+        means.append(m)
+    return np.stack(means, axis=-1).astype(values.dtype)
+
+
+def origins_mean(values, t, p, known, tensor):
+    """Mean of `values` on the dates at positions `t` over the origins of
+    the trips into each province of `tensor`, weighted by their fluxes.
+
+    `p` are the positions of the tensor provinces in `values`, for those
+    `known` there. Origins without values are left out.
+    """
+    origin = np.full((len(t), len(known)), np.nan, dtype="float32")
+    origin[np.ix_(t >= 0, known)] = values[np.ix_(t[t >= 0], p[known])]
+    ok = np.isfinite(origin)
+
+    weighted = flux.mobility_weighted(tensor, np.where(ok, origin, 0))
+    inflow = flux.mobility_weighted(tensor, ok.astype(tensor.dtype))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return weighted / inflow
+
+
+def mobility_incidence(values, dates, ids, base_dir):
+    """Target of the origins of the trips into each province, the day before.
+
+    It is the mean over the other provinces weighted by the flux from them,
+    on the dates of the flux tensor. The fluxes arrive later than the cases,
+    so the dates after the last one of the tensor, including the one to
+    forecast from, take the fluxes of that last date. Dates before it
+    without fluxes are NaN.
+    """
+    f_dates, f_ids, tensor = flux.read_flux_tensor(base_dir)
+
+    # Positions of the axes of the tensor in `values`
+    t = dates.get_indexer(f_dates)
+    p = np.searchsorted(ids, f_ids).clip(max=len(ids) - 1)
+    known = ids[p] == f_ids
+
+    weighted = origins_mean(values, t, p, known, tensor)
+
+    # Dates after the last of the fluxes, but for the one to forecast from,
+    # whose values are those of the day before
+    carried = np.flatnonzero(dates[:-1] > f_dates[-1])
+    if len(carried):
+        t = np.concatenate([t, carried])
+        weighted = np.concatenate([
+            weighted,
+            origins_mean(values, carried, p, known, tensor[-1:]),
+        ])
+
+    # Shifted to the next date
+    result = np.full(values.shape, np.nan, dtype=values.dtype)
+    rows = (t >= 0) & (t + 1 < len(dates))
+    result[np.ix_(t[rows] + 1, p[known])] = weighted[np.ix_(rows, known)]
+    return result
+
+
+def neighbours_incidence(values, ids, base_dir):
+    """Mean target of the neighbouring provinces, the day before.
+
+    Provinces without neighbours (the islands, Ceuta and Melilla) get their
+    own target, so that their rows are not dropped.
+    """
+    a_ids, adj = adjacency.read_adjacency(base_dir, "provinces")
+    p = np.searchsorted(a_ids, ids).clip(max=len(a_ids) - 1)
+    known = a_ids[p] == ids
+    adj = adj[p[known]][:, p[known]]
+
+    lag = np.full(values.shape, np.nan, dtype=values.dtype)
+    lag[:, known] = adjacency.spatial_lag(adj, values[:, known])
+    isolated = np.flatnonzero(known)[np.diff(adj.indptr) == 0]
+    lag[:, isolated] = values[:, isolated]
+
+    result = np.full(values.shape, np.nan, dtype=values.dtype)
+    result[1:] = lag[:-1]
+    return result
+
+
+def build_features(df, base_dir, target=TARGET, k=LAGS, windows=ROLLING):
+    """Features and target of the provinces in `df`, on all the dates.
+
+    Returns the dates, province ids and feature names, the provinces x
+    dates x features array and the provinces x dates target, as float32.
+    """
+    # One more date, whose features predict the day after the last data
+    dates = pd.date_range(df["date"].min(),
+                          df["date"].max() + pd.Timedelta(days=1))
+    ids = np.sort(df["province id"].unique())
+    values = province_array(df, target, dates, ids)
+
+    names = [f"{target} lag {j}" for j in range(1, k + 1)]
+    names += [f"{target} mean {w}" for w in windows]
+    names += [f"{target} origins lag 1", f"{target} neighbours lag 1"]
+
+    features = np.concatenate([
+        lags(values, k),
+        rolling_means(values, windows),
+        mobility_incidence(values, dates, ids, base_dir)[..., None],
+        neighbours_incidence(values, ids, base_dir)[..., None],
+    ], axis=-1)
+
+    return (dates, ids, names,
+            np.ascontiguousarray(features.transpose(1, 0, 2)),
+            np.ascontiguousarray(values.T))
+
+
+def write_features(base_dir, dates, ids, names, features, target):
+    np.save(base_dir / "processed" / "province-features.npy", features)
+    np.savez(
+        base_dir / "processed" / "province-features-index.npz",
+        dates=dates.values.astype("datetime64[D]"),
+        ids=ids,
+        names=np.array(names),
+        target=target,
+    )
+
+
+def read_features(base_dir, mmap_mode="r"):
+    """Read the features from `processed`, memory-mapped by default.
+
+    Returns the same as `build_features`.
+    """
+    features = np.load(
+        base_dir / "processed" / "province-features.npy",
+        mmap_mode=mmap_mode,
+    )
+    with np.load(base_dir / "processed" / "province-features-index.npz") as f:
+        dates = pd.DatetimeIndex(f["dates"])
+        ids = f["ids"]
+        names = f["names"].tolist()
+        target = f["target"]
+    return dates, ids, names, features, target
+
+
+def design_matrix(features, target):
+    """Rows of the provinces and dates with all the features and target.
+
+    Returns the rows x features matrix, the target of each row and the
+    province and date positions of the rows.
+    """
+    x = features.reshape(-1, features.shape[-1])
+    y = target.reshape(-1)
+    ok = np.isfinite(x).all(axis=1) & np.isfinite(y)
+    p, t = np.divmod(np.flatnonzero(ok), target.shape[1])
+    return x[ok], y[ok], p, t
+
+
+def municipality_spatial_lag(df, base_dir, columns):
+    """Add the mean of `columns` over the neighbours of each municipality on
+    the same date, as `<column> neighbours`."""
+    ids, adj = adjacency.read_adjacency(base_dir, "municipalities")
+    dates = pd.DatetimeIndex(np.sort(df["Fecha"].unique()))
+    codes = df["Codigo"].astype("int").values
+
+    t = dates.get_indexer(df["Fecha"])
+    p = np.searchsorted(ids, codes).clip(max=len(ids) - 1)
+    ok = ids[p] == codes
+
+    df = df.copy()
+    for c in columns:
+        values = np.full((len(dates), len(ids)), np.nan, dtype="float32")
+        values[t[ok], p[ok]] = df[c].values[ok]
+        lag = adjacency.spatial_lag(adj, values)
+        df[f"{c} neighbours"] = np.where(ok, lag[t, p], np.nan)
+    return df
+
+
+@click.command()
+@click.argument('base_dir', type=click.Path(exists=True))
+@click.option('--target', default=TARGET, show_default=True,
+              help="Column of provinces-incidence to predict.")
+@click.option('--lags', 'k', type=int, default=LAGS, show_default=True,
+              help="Days of the target used as features.")
+def main(base_dir, target, k):
+    """ Builds the features of the province incidence from (../processed)
+        (saved in ../processed).
+    """
+    base_dir = pathlib.Path(base_dir)
+
+    df = utils.read_processed(base_dir, "provinces-incidence",
+                              columns=["date", "province id", target])
+    dates, ids, names, features, y = build_features(df, base_dir, target, k)
+
+    LOG.info(f"Writing {len(names)} features of {len(ids)} provinces on "
+             f"{len(dates)} dates")
+    write_features(base_dir, dates, ids, names, features, y)
+
+    columns = ["incidence 7", "incidence 14"]
+    df = utils.read_processed(base_dir, "cantabria-history",
+                              columns=["Fecha", "Codigo"] + columns,
+                              date="Fecha")
+    if df is not None:
+        df = municipality_spatial_lag(df, base_dir, columns)
+        df.to_csv(base_dir / "processed" / "cantabria-spatial-lag.csv",
+                  index=False)
+        LOG.info(f"Writing the neighbours incidence of "
+                 f"{df['Codigo'].nunique()} municipalities on "
+                 f"{df['Fecha'].nunique()} dates")
+
+
+if __name__ == '__main__':
+
+    # not used in this stub but often useful for finding various files
+    project_dir = pathlib.Path(__file__).resolve().parents[2]
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,207 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rolling-origin backtest of the forecasting models.
+
+For each origin date, the models are fitted on the rows whose target is
+known before it and forecast all the provinces from its features, as
+`train_model` and `predict_model` would have done on that day. The
+features only use past data, so they are built once and each fold selects
+its rows from the same design matrices. Folds run in a process pool, and
+the errors are compared with the persistence forecast (the last known
+target).
+"""
+
+import datetime
+import logging
+import pathlib
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import joblib
+import numpy as np
+import pandas as pd
+
+from src.features import build_features
+from src.models import predict_model, train_model
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+REPORT_DIR = train_model.MODELS_DIR.parent / "reports"
+
+# Days of data before the first origin
+MIN_TRAIN = 56
+
+# Days between origins
+STEP = 7
+
+
+def design_matrices(features, target, horizons):
+    """Rows of the design matrix of each horizon, with their positions."""
+    return {
+        h: build_features.design_matrix(
+            features, train_model.horizon_target(target, h)
+        )
+        for h in horizons
+    }
+
+
+def fold(matrices, x0, t0, n, model, params, pooled):
+    """Fit the models on the rows known before date `t0` and forecast the
+    `n` provinces from their features `x0` on it.
+
+    Returns a provinces x horizons array.
+    """
+    models = {}
+    for h, (x, y, p, t) in matrices.items():
+        train = t + h - 1 < t0
+        if pooled:
+            if train.any():
+                models[None, h] = train_model.fit(x[train], y[train],
+                                                  model, params)
+            continue
+        for i in range(n):
+            rows = train & (p == i)
+            if rows.any():
+                models[i, h] = train_model.fit(x[rows], y[rows],
+                                               model, params)
+
+    bundle = {"pooled": pooled, "horizons": list(matrices), "models": models}
+    return predict_model.predict_batch(bundle, x0)
+
+
+def backtest(base_dir, model="ridge", params=None, pooled=False,
+             horizons=train_model.HORIZONS, min_train=MIN_TRAIN, step=STEP,
+             jobs=1):
+    """Forecasts and errors of each origin, province and horizon."""
+    dates, ids, _, features, target = build_features.read_features(base_dir)
+    horizons = list(horizons)
+    matrices = design_matrices(features, target, horizons)
+
+    # Origins whose shortest horizon can be checked
+    origins = np.arange(min_train, len(dates) - min(horizons) + 1, step)
+    LOG.info(f"Backtesting {len(origins)} origins of {len(ids)} provinces "
+             f"in {jobs} processes")
+
+    forecasts = joblib.Parallel(n_jobs=jobs)(
+        joblib.delayed(fold)(
+            matrices, np.asarray(features[:, t0, :]), t0, len(ids), model,
+            params or {}, pooled,
+        )
+        for t0 in origins
+    )
+
+    h = np.array(horizons)
+    t0 = np.repeat(origins, len(ids) * len(h))
+    p = np.tile(np.repeat(np.arange(len(ids)), len(h)), len(origins))
+    h = np.tile(h, len(origins) * len(ids))
+
+    known = t0 + h - 1 < target.shape[1]
+    actual = np.full(len(t0), np.nan)
+    actual[known] = target[p[known], (t0 + h - 1)[known]]
+
+    # Persistence: the target the day before the origin, the first feature
+    persistence = np.asarray(features[:, :, 0])[p, t0]
+
+    df = pd.DataFrame({
+        "province id": ids[p],
+        "origin": dates[t0],
+        "horizon": h,
+        "prediction": np.concatenate(forecasts).ravel(),
+        "persistence": persistence,
+        "actual": actual,
+    })
+    return df.dropna(subset=["actual"])
+
+
+def error_table(df, by):
+    """Errors of the model and the persistence forecast, grouped by `by`."""
+    df = df.dropna(subset=["prediction"]).assign(
+        error=lambda d: d["prediction"] - d["actual"],
+        persistence_error=lambda d: d["persistence"] - d["actual"],
+    )
+    g = df.groupby(by)
+    table = pd.DataFrame({
+        "forecasts": g.size(),
+        "mae": g["error"].apply(lambda e: e.abs().mean()),
+        "rmse": g["error"].apply(lambda e: np.sqrt((e ** 2).mean())),
+        "bias": g["error"].mean(),
+        "persistence mae": g["persistence_error"].apply(
+            lambda e: e.abs().mean()
+        ),
+    })
+    table["skill"] = 1 - table["mae"] / table["persistence mae"]
+    return table
+
+
+@click.command()
+@click.argument('base_dir', type=click.Path(exists=True))
+@click.option('--model', type=click.Choice(list(train_model.MODELS)),
+              default="ridge", show_default=True)
+@click.option('--param', 'params', multiple=True,
+              help="Hyperparameter of the model, as name=value.")
+@click.option('--pooled', is_flag=True,
+              help="Fit one model for all the provinces.")
+@click.option('--horizon', 'horizons', type=int, multiple=True,
+              default=train_model.HORIZONS, show_default=True)
+@click.option('--min-train', type=int, default=MIN_TRAIN, show_default=True,
+              help="Days of data before the first origin.")
+@click.option('--step', type=int, default=STEP, show_default=True,
+              help="Days between origins.")
+@click.option('--jobs', type=int, default=1, show_default=True,
+              help="Processes running folds (-1 for all the CPUs).")
+@click.option('--report-dir', type=click.Path(file_okay=False),
+              default=REPORT_DIR, show_default=True)
+def main(base_dir, model, params, pooled, horizons, min_train, step, jobs,
+         report_dir):
+    """ Backtests the forecasting models on the features in (../processed),
+        saving the errors by province and horizon in (../../reports).
+    """
+    df = backtest(
+        pathlib.Path(base_dir),
+        model=model,
+        params=train_model.parse_params(params),
+        pooled=pooled,
+        horizons=sorted(horizons),
+        min_train=min_train,
+        step=step,
+        jobs=jobs,
+    )
+
+    report_dir = pathlib.Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+    prefix = f"backtest-{datetime.datetime.now():%Y%m%dT%H%M%S}"
+
+    by_horizon = error_table(df, "horizon")
+    with pd.option_context("display.width", 200,
+                           "display.max_columns", None):
+        print(by_horizon.round(3))
+    by_horizon.to_csv(report_dir / f"{prefix}-horizon.csv")
+    error_table(df, ["province id", "horizon"]).to_csv(
+        report_dir / f"{prefix}-province.csv"
+    )
+    df.to_csv(report_dir / f"{prefix}-forecasts.csv", index=False)
+    LOG.info(f"Errors written to '{report_dir / prefix}-*.csv'")
+
+
+if __name__ == '__main__':
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,166 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Forecast of the incidence of all the provinces and horizons at once.
+
+Linear models are evaluated together, as a single product of the features
+of all the provinces with their stacked coefficients. Other models are
+evaluated once per horizon when pooled, or once per model otherwise.
+"""
+
+import logging
+import pathlib
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import joblib
+import numpy as np
+import pandas as pd
+
+from src.features import build_features
+from src.models import train_model
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+
+def is_linear(estimator):
+    return hasattr(estimator, "coef_") and hasattr(estimator, "intercept_")
+
+
+def stacked_linear(models, keys, n_features):
+    """Coefficients and intercepts of the linear models of each province
+    and horizon, NaN intercepts where there is no model."""
+    coef = np.zeros((len(keys), len(keys[0]), n_features))
+    intercept = np.full((len(keys), len(keys[0])), np.nan)
+    for p, row in enumerate(keys):
+        for j, key in enumerate(row):
+            if key in models:
+                coef[p, j] = models[key].coef_
+                intercept[p, j] = models[key].intercept_
+    return coef, intercept
+
+
+def predict_batch(bundle, x):
+    """Predictions of the provinces x features `x`, for all the horizons.
+
+    Returns a provinces x horizons array, NaN where a province has missing
+    features or no model.
+    """
+    horizons = bundle["horizons"]
+    models = bundle["models"]
+    ok = np.isfinite(x).all(axis=1)
+    pred = np.full((x.shape[0], len(horizons)), np.nan)
+
+    # Estimator of each province and horizon, the same for all the
+    # provinces when pooled
+    keys = [[(None, h) if bundle["pooled"] else (p, h) for h in horizons]
+            for p in range(x.shape[0])]
+
+    if all(is_linear(m) for m in models.values()):
+        coef, intercept = stacked_linear(models, keys, x.shape[1])
+        pred[ok] = (np.einsum("pf,phf->ph", x[ok], coef[ok]) +
+                    intercept[ok])
+        return pred
+
+    if bundle["pooled"]:
+        for j, h in enumerate(horizons):
+            if (None, h) in models and ok.any():
+                pred[ok, j] = models[None, h].predict(x[ok])
+        return pred
+
+    for p in np.flatnonzero(ok):
+        for j, key in enumerate(keys[p]):
+            if key in models:
+                pred[p, j] = models[key].predict(x[p:p + 1])[0]
+    return pred
+
+
+def predict(bundle, base_dir, t=-1):
+    """Forecast of all the provinces and horizons from the features of the
+    `t`-th date (the day after the last data by default).
+    """
+    dates, ids, _, features, _ = build_features.read_features(base_dir)
+    if not np.array_equal(ids, bundle["ids"]):
+        raise ValueError("The provinces of the features and the models "
+                         "differ, train the models again")
+
+    date = dates[t]
+    pred = predict_batch(bundle, np.asarray(features[:, t, :]))
+
+    horizons = np.array(bundle["horizons"])
+    return pd.DataFrame({
+        "province id": np.repeat(ids, len(horizons)),
+        "date": date,
+        "horizon": np.tile(horizons, len(ids)),
+        "target date": date + pd.to_timedelta(
+            np.tile(horizons - 1, len(ids)), unit="D"
+        ),
+        "prediction": pred.ravel(),
+    })
+
+
+def latest_model(models_dir):
+    files = sorted(models_dir.glob("*.joblib"),
+                   key=lambda f: f.stat().st_mtime)
+    if not files:
+        raise click.ClickException(f"No models in '{models_dir}', run "
+                                   "`make train` first")
+    return files[-1]
+
+
+@click.command()
+@click.argument('base_dir', type=click.Path(exists=True))
+@click.option('--model-file', type=click.Path(exists=True, dir_okay=False),
+              help="Models to use [default: the last saved in "
+                   "--models-dir]")
+@click.option('--models-dir', type=click.Path(file_okay=False),
+              default=train_model.MODELS_DIR, show_default=True)
+def main(base_dir, model_file, models_dir):
+    """ Forecasts the incidence of all the provinces from the features in
+        (../processed) (saved in ../processed).
+    """
+    base_dir = pathlib.Path(base_dir)
+    f = (pathlib.Path(model_file) if model_file
+         else latest_model(pathlib.Path(models_dir)))
+    LOG.info(f"Loading the models from '{f}'")
+    bundle = joblib.load(f)
+
+    if bundle["version"] != train_model.features_version(base_dir):
+        LOG.warning("The models were fitted on other features, they may "
+                    "need to be trained again")
+
+    df = predict(bundle, base_dir)
+    missing = df.loc[df["prediction"].isna(), "province id"].unique()
+    if len(missing) == df["province id"].nunique():
+        raise click.ClickException("No province could be forecast, with "
+                                   "incomplete features or no model")
+    if len(missing):
+        LOG.warning(f"No forecast for {len(missing)} provinces, with "
+                    f"incomplete features or no model: "
+                    f"{', '.join(str(i) for i in missing)}")
+    df.to_csv(base_dir / "processed" / "province-forecast.csv", index=False)
+    LOG.info(f"Forecast of {df['province id'].nunique()} provinces from "
+             f"{df['date'].iloc[0]:%Y-%m-%d} written")
+
+
+if __name__ == '__main__':
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
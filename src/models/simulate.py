@@ -0,0 +1,273 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""SEIR metapopulation scenarios of the provinces coupled by the fluxes.
+
+Each day, a fraction of the residents of each province spends the day in
+the others, given by the fluxes out of it over its population. Residents
+are infected at the rate of the places they spend the day in, where the
+infectious of all the provinces mix. All the provinces, parameter sets and
+mobility scenarios are simulated at once: the state of a run is a row of a
+scenarios x parameter sets x provinces array, and the coupling a batched
+matrix product with the scenarios x provinces x provinces mobility.
+"""
+
+import logging
+import pathlib
+import time
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import numpy as np
+import pandas as pd
+
+from src.data import flux, utils
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+# Ranges of the parameters sampled for the ensembles
+R0 = (1.0, 3.0)
+INCUBATION = (4.0, 6.0)
+INFECTIOUS = (5.0, 10.0)
+
+# Euler steps per day
+SUBSTEPS = 4
+
+
+def sample_parameters(n, rng, r0=R0, incubation=INCUBATION,
+                      infectious=INFECTIOUS):
+    """Transmission, incubation and recovery rates of `n` random runs."""
+    r0 = rng.uniform(*r0, n)
+    gamma = 1 / rng.uniform(*infectious, n)
+    return {
+        "beta": r0 * gamma,
+        "sigma": 1 / rng.uniform(*incubation, n),
+        "gamma": gamma,
+    }
+
+
+def scenario_trips(trips, ids, scenarios):
+    """Trips of each scenario, with the outflow of some provinces scaled.
+
+    `scenarios` is a list of {province id: factor} dicts, e.g. {28: 0.5}
+    halves the trips out of Madrid. Returns a scenarios x origin x
+    destination array.
+    """
+    result = np.repeat(trips[None], len(scenarios), axis=0)
+    for s, factors in enumerate(scenarios):
+        for pid, factor in factors.items():
+            p = np.searchsorted(ids, pid)
+            if p == len(ids) or ids[p] != pid:
+                raise ValueError(f"No fluxes of province {pid}")
+            result[s, p] *= factor
+    return result
+
+
+def mobility_fractions(trips, population):
+    """Fraction of the residents of each origin spending the day in each
+    destination, the rest staying in the origin.
+
+    Trips are capped to the population of the origin.
+    """
+    eye = np.eye(trips.shape[-1], dtype=bool)
+    away = np.where(eye, 0, trips) / population[:, None]
+    total = away.sum(axis=-1, keepdims=True)
+    away = np.where(total > 1, away / np.maximum(total, 1), away)
+    return away + eye * (1 - away.sum(axis=-1, keepdims=True))
+
+
+def simulate(fractions, population, params, infected, exposed, recovered,
+             days, substeps=SUBSTEPS):
+    """Daily new infectious of each scenario, parameter set and province.
+
+    `fractions` is the scenarios x origin x destination output of
+    `mobility_fractions`, `params` the output of `sample_parameters` and
+    the initial compartments are arrays over the provinces. Returns a
+    scenarios x parameter sets x days x provinces float32 array.
+    """
+    n = len(params["beta"])
+    shape = (fractions.shape[0], n, fractions.shape[1])
+    beta, sigma, gamma = (params[k][None, :, None] * (1 / substeps)
+                          for k in ["beta", "sigma", "gamma"])
+
+    e = np.broadcast_to(exposed, shape).astype("float64")
+    i = np.broadcast_to(infected, shape).astype("float64")
+    s = np.broadcast_to(population - infected - exposed - recovered,
+                        shape).astype("float64")
+
+    # People present in each province during the day
+    present = np.matmul(population, fractions)[:, None, :]
+    back = fractions.transpose(0, 2, 1)
+
+    new = np.zeros((shape[0], n, days, shape[2]), dtype="float32")
+    for day in range(days):
+        for _ in range(substeps):
+            # Infection rate in each destination, brought back to the
+            # origins in proportion to the time spent there
+            rate = np.matmul(i, fractions) / present
+            infections = np.minimum(beta * np.matmul(rate, back) * s, s)
+            onsets = sigma * e
+            s -= infections
+            e += infections - onsets
+            i += onsets - gamma * i
+            new[:, :, day] += onsets
+    return new
+
+
+def read_initial_state(base_dir, ids, population):
+    """Infected, exposed and recovered of each province on the last date of
+    `provinces-incidence`.
+
+    The cases of the last 7 days are taken as infectious, as many again as
+    exposed, and the rest of the cases as recovered.
+    """
+    df = utils.read_processed(
+        base_dir, "provinces-incidence",
+        columns=["date", "province id", "incidence 7", "cases acc (pcr)"],
+    )
+    df = df[df["date"] == df["date"].max()]
+    df = df.set_index("province id").reindex(ids).fillna(0)
+
+    infected = df["incidence 7"].values * population / 100000
+    recovered = np.maximum(df["cases acc (pcr)"].values - 2 * infected, 0)
+    return infected, infected.copy(), recovered
+
+
+def read_trips(base_dir, days):
+    """Mean daily fluxes of the last `days` dates, with the province ids."""
+    _, ids, tensor = flux.read_flux_tensor(base_dir)
+    return ids, np.asarray(tensor[-days:], dtype="float64").mean(axis=0)
+
+
+def summarize(new, population, ids, labels):
+    """Quantiles over the parameter sets of the peak daily incidence per
+    100k, the day of the peak and the attack rate, per scenario and
+    province."""
+    incidence = new / population * 100000
+    peak = incidence.max(axis=2)
+    peak_day = incidence.argmax(axis=2)
+    attack = new.sum(axis=2) / population
+
+    columns = {}
+    for name, values in [("peak incidence", peak), ("peak day", peak_day),
+                         ("attack rate", attack)]:
+        for q in [0.05, 0.5, 0.95]:
+            columns[f"{name} q{q * 100:g}"] = np.quantile(
+                values, q, axis=1
+            ).ravel()
+    return pd.DataFrame({
+        "scenario": np.repeat(labels, len(ids)),
+        "province id": np.tile(ids, len(labels)),
+        **columns,
+    })
+
+
+def parse_scenario(value):
+    """{province id: factor} from an `id=factor[,id=factor]` string."""
+    factors = {}
+    for item in value.split(","):
+        pid, _, factor = item.partition("=")
+        factors[int(pid)] = float(factor)
+    return factors
+
+
+def validate_scenarios(ctx, param, value):
+    """Parse the --scenario values, checking that their factors are not
+    negative and that their provinces have fluxes in BASE_DIR.
+
+    Returns a list of (value, {province id: factor}).
+    """
+    if not value:
+        return []
+    _, ids, _ = flux.read_flux_tensor(pathlib.Path(ctx.params["base_dir"]))
+
+    scenarios = []
+    for v in value:
+        try:
+            factors = parse_scenario(v)
+        except ValueError:
+            raise click.BadParameter(f"'{v}' is not id=factor[,id=factor]")
+        invalid = sorted(k for k, f in factors.items()
+                         if not (np.isfinite(f) and f >= 0))
+        if invalid:
+            raise click.BadParameter(
+                f"the factors of the provinces {invalid} in '{v}' are not "
+                f"finite non-negative numbers"
+            )
+        unknown = sorted(set(factors) - set(ids.tolist()))
+        if unknown:
+            raise click.BadParameter(
+                f"no fluxes of the provinces {unknown} in '{v}'"
+            )
+        scenarios.append((v, factors))
+    return scenarios
+
+
+@click.command()
+@click.argument('base_dir', type=click.Path(exists=True), is_eager=True)
+@click.option('--scenario', 'scenarios', multiple=True,
+              callback=validate_scenarios,
+              help="Outflow of provinces scaled by a factor, as "
+                   "id=factor[,id=factor]. 28=0.5 halves the trips out of "
+                   "Madrid. The unchanged mobility is always run.")
+@click.option('--samples', type=int, default=500, show_default=True,
+              help="Parameter sets of each scenario.")
+@click.option('--days', type=int, default=90, show_default=True,
+              help="Days simulated.")
+@click.option('--flux-days', type=int, default=7, show_default=True,
+              help="Last days of fluxes averaged into the mobility.")
+@click.option('--seed', type=int, default=0, show_default=True)
+def main(base_dir, scenarios, samples, days, flux_days, seed):
+    """ Simulates mobility scenarios from the last data in (../processed)
+        (saved in ../processed).
+    """
+    base_dir = pathlib.Path(base_dir)
+
+    ids, trips = read_trips(base_dir, flux_days)
+    pop = utils.read_population(base_dir).set_index("province id")["Total"]
+    population = pop.reindex(ids).values.astype("float64")
+    if np.isnan(population).any():
+        raise click.ClickException("Provinces of the fluxes without "
+                                   "population")
+
+    labels = ["baseline"] + [v for v, _ in scenarios]
+    fractions = mobility_fractions(
+        scenario_trips(trips, ids, [{}] + [f for _, f in scenarios]),
+        population,
+    )
+    params = sample_parameters(samples, np.random.default_rng(seed))
+    state = read_initial_state(base_dir, ids, population)
+
+    t = time.perf_counter()
+    new = simulate(fractions, population, params, *state, days)
+    elapsed = time.perf_counter() - t
+    LOG.info(f"Simulated {len(labels) * samples} runs of {len(ids)} "
+             f"provinces over {days} days in {elapsed:.2f}s "
+             f"({len(labels) * samples / elapsed * 60:.0f} runs/minute)")
+
+    df = summarize(new, population, ids, labels)
+    df.to_csv(base_dir / "processed" / "province-scenarios.csv",
+              index=False)
+
+
+if __name__ == '__main__':
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
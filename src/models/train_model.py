@@ -0,0 +1,195 @@
+# Copyright (c) 2020 Spanish National Research Council
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Models forecasting the province incidence at several horizons.
+
+For each horizon, either one model is fitted per province or a single
+pooled model on all of them. The features of a date (see
+`src/features/build_features.py`) predict the target `h - 1` days later for
+horizon `h`, so horizon 1 is the date itself. Models are fitted in parallel
+and saved in `models`, under a name made of the version of the features and
+the hyperparameters, so that they are only fitted again when either changes.
+"""
+
+import hashlib
+import json
+import logging
+import pathlib
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import joblib
+import numpy as np
+from sklearn import ensemble, linear_model
+
+from src.features import build_features
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+MODELS_DIR = pathlib.Path(__file__).resolve().parents[2] / "models"
+
+# Days ahead predicted
+HORIZONS = (1, 7, 14)
+
+# Estimators that can be fitted, by name
+MODELS = {
+    "ridge": linear_model.Ridge,
+    "gbr": ensemble.HistGradientBoostingRegressor,
+}
+
+
+def horizon_target(target, h):
+    """Target `h - 1` days after each date, NaN past the last one."""
+    shifted = np.full(target.shape, np.nan, dtype=target.dtype)
+    shifted[:, :target.shape[1] - h + 1] = target[:, h - 1:]
+    return shifted
+
+
+def features_version(base_dir):
+    """Short hash of the contents of the features in `processed`."""
+    h = hashlib.sha256()
+    for name in ["province-features.npy", "province-features-index.npz"]:
+        with open(base_dir / "processed" / name, "rb") as fd:
+            while block := fd.read(1 << 20):
+                h.update(block)
+    return h.hexdigest()[:12]
+
+
+def model_path(models_dir, version, model, params, pooled, horizons):
+    """File of the models fitted with the given settings."""
+    settings = json.dumps(
+        [version, model, params, pooled, list(horizons)], sort_keys=True
+    )
+    key = hashlib.sha256(settings.encode()).hexdigest()[:12]
+    kind = "pooled" if pooled else "province"
+    return models_dir / f"{model}-{kind}-{key}.joblib"
+
+
+def fit(x, y, model, params):
+    return MODELS[model](**params).fit(x, y)
+
+
+def training_sets(features, target, horizons, pooled):
+    """Rows of each model to fit, keyed by province position and horizon.
+
+    The province position is None for pooled models.
+    """
+    for h in horizons:
+        y_h = horizon_target(target, h)
+        if pooled:
+            x, y, _, _ = build_features.design_matrix(features, y_h)
+            yield (None, h), x, y
+            continue
+        for p in range(features.shape[0]):
+            x, y, _, _ = build_features.design_matrix(features[p:p + 1],
+                                                      y_h[p:p + 1])
+            yield (p, h), x, y
+
+
+def train(base_dir, models_dir=MODELS_DIR, model="ridge", params=None,
+          pooled=False, horizons=HORIZONS, jobs=1):
+    """Fit the models on the features in `base_dir`, or load them if saved.
+
+    Returns a dict with the settings, the province ids and feature names,
+    and the fitted models by (province position or None, horizon).
+    """
+    params = params or {}
+    version = features_version(base_dir)
+    f = model_path(models_dir, version, model, params, pooled, horizons)
+    if f.exists():
+        LOG.info(f"Loading the models fitted on version {version} from "
+                 f"'{f}'")
+        return joblib.load(f)
+
+    _, ids, names, features, target = build_features.read_features(base_dir)
+
+    keys, tasks = [], []
+    for key, x, y in training_sets(features, target, horizons, pooled):
+        if not len(y):
+            LOG.warning(f"No rows to fit the model of {key}, skipping it")
+            continue
+        keys.append(key)
+        tasks.append(joblib.delayed(fit)(x, y, model, params))
+
+    LOG.info(f"Fitting {len(tasks)} {model} models in {jobs} processes")
+    fitted = joblib.Parallel(n_jobs=jobs)(tasks)
+
+    bundle = {
+        "version": version,
+        "model": model,
+        "params": params,
+        "pooled": pooled,
+        "horizons": list(horizons),
+        "ids": ids,
+        "names": names,
+        "models": dict(zip(keys, fitted)),
+    }
+
+    models_dir.mkdir(parents=True, exist_ok=True)
+    joblib.dump(bundle, f)
+    LOG.info(f"Models saved to '{f}'")
+    return bundle
+
+
+def parse_params(values):
+    """Hyperparameters from `name=value` strings, values parsed as JSON."""
+    params = {}
+    for v in values:
+        k, _, v = v.partition("=")
+        try:
+            params[k] = json.loads(v)
+        except json.JSONDecodeError:
+            params[k] = v
+    return params
+
+
+@click.command()
+@click.argument('base_dir', type=click.Path(exists=True))
+@click.option('--model', type=click.Choice(list(MODELS)), default="ridge",
+              show_default=True)
+@click.option('--param', 'params', multiple=True,
+              help="Hyperparameter of the model, as name=value.")
+@click.option('--pooled', is_flag=True,
+              help="Fit one model for all the provinces.")
+@click.option('--horizon', 'horizons', type=int, multiple=True,
+              default=HORIZONS, show_default=True)
+@click.option('--jobs', type=int, default=1, show_default=True,
+              help="Processes fitting models (-1 for all the CPUs).")
+@click.option('--models-dir', type=click.Path(file_okay=False),
+              default=MODELS_DIR, show_default=True)
+def main(base_dir, model, params, pooled, horizons, jobs, models_dir):
+    """ Fits the forecasting models on the features in (../processed)
+        (saved in ../../models).
+    """
+    train(
+        pathlib.Path(base_dir),
+        models_dir=pathlib.Path(models_dir),
+        model=model,
+        params=parse_params(params),
+        pooled=pooled,
+        horizons=sorted(horizons),
+        jobs=jobs,
+    )
+
+
+if __name__ == '__main__':
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
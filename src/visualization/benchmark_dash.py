@@ -0,0 +1,174 @@
+"""
+Benchmark the latency and payload of the dashboard callbacks, without a
+browser.
+
+The app is built with `visualize_dash.create_app` without serving it, and
+the server callbacks are requested through the Flask test client for every
+value of the controls they depend on (the metric radio items and the date
+slider), as the browser would do. Requests can be sent from a pool of
+threads to simulate concurrent users.
+"""
+
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import pathlib
+import threading
+import time
+
+import click
+from dotenv import find_dotenv, load_dotenv
+import numpy as np
+import pandas as pd
+
+from src.visualization import visualize_dash
+
+log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=log_fmt)
+LOG = logging.getLogger(__name__)
+
+PROJECT_DIR = pathlib.Path(__file__).resolve().parents[2]
+
+UPDATE_URL = "/_dash-update-component"
+
+
+def control_values(component):
+    """Values a user can give to a control, None if it is not one."""
+    if hasattr(component, "options"):
+        return [o["value"] for o in component.options]
+    if hasattr(component, "min") and hasattr(component, "max"):
+        step = getattr(component, "step", None) or 1
+        return list(range(component.min, component.max + 1, step))
+    return None
+
+
+def update_requests(app):
+    """Bodies of the update requests of the server callbacks.
+
+    One request is made for each combination of the values of the controls
+    the callback depends on. Callbacks run in the browser, or depending on
+    other outputs, are left out.
+    """
+    layout = app.layout() if callable(app.layout) else app.layout
+    components = {
+        c.id: c for c in layout._traverse() if getattr(c, "id", None)
+    }
+
+    for output, callback in app.callback_map.items():
+        if "callback" not in callback:
+            continue
+        inputs = callback["inputs"]
+        values = [control_values(components[i["id"]]) for i in inputs]
+        if any(v is None for v in values):
+            continue
+
+        for combination in itertools.product(*values):
+            yield output, {
+                "output": output,
+                "inputs": [dict(i, value=v)
+                           for i, v in zip(inputs, combination)],
+                "state": [],
+                "changedPropIds": [f"{inputs[0]['id']}.value"],
+            }
+
+
+def run_requests(app, requests, threads=1):
+    """Send the requests from `threads` threads, one test client each.
+
+    Returns the callback, latency (s) and response size (bytes) of each.
+    """
+    local = threading.local()
+
+    def send(request):
+        output, body = request
+        if not hasattr(local, "client"):
+            local.client = app.server.test_client()
+        t = time.perf_counter()
+        response = local.client.post(UPDATE_URL, json=body)
+        latency = time.perf_counter() - t
+        if response.status_code != 200:
+            raise RuntimeError(f"Callback '{output}' failed with status "
+                               f"{response.status_code}")
+        return output, latency, len(response.data)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        return pd.DataFrame(
+            list(pool.map(send, requests)),
+            columns=["callback", "latency", "bytes"],
+        )
+
+
+def summarize(results):
+    """Latency percentiles (ms) and payload size of each callback."""
+    g = results.groupby("callback")
+    latency = g["latency"]
+    return pd.DataFrame({
+        "calls": g.size(),
+        "p50 (ms)": latency.quantile(0.5) * 1000,
+        "p90 (ms)": latency.quantile(0.9) * 1000,
+        "p99 (ms)": latency.quantile(0.99) * 1000,
+        "max (ms)": latency.max() * 1000,
+        "mean bytes": g["bytes"].mean(),
+        "max bytes": g["bytes"].max(),
+    })
+
+
+@click.command()
+@click.argument('data_dir', type=click.Path(exists=True),
+                default=PROJECT_DIR / "data")
+@click.option('--repeat', type=int, default=3, show_default=True,
+              help="Times each request is sent, the first ones are cold.")
+@click.option('--threads', type=int, default=1, show_default=True,
+              help="Threads sending requests at the same time.")
+def main(data_dir, repeat, threads):
+    """ Benchmarks the callbacks of the dashboard built on DATA_DIR, saving
+        the results in (../../reports/benchmarks).
+    """
+    t = time.perf_counter()
+    app = visualize_dash.create_app(pathlib.Path(data_dir))
+    startup = time.perf_counter() - t
+
+    client = app.server.test_client()
+    layout = len(client.get("/_dash-layout").data)
+
+    requests = list(update_requests(app))
+    t = time.perf_counter()
+    results = run_requests(app, requests * repeat, threads=threads)
+    wall = time.perf_counter() - t
+
+    summary = summarize(results)
+    LOG.info(f"Startup {startup:.2f}s, layout {layout} bytes")
+    LOG.info(f"{len(results)} requests in {wall:.2f}s with {threads} "
+             f"threads ({len(results) / wall:.1f} requests/s)")
+    with pd.option_context("display.width", 200,
+                           "display.max_columns", None):
+        print(summary.round(2))
+
+    report = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "threads": threads,
+        "repeat": repeat,
+        "startup (s)": startup,
+        "layout bytes": layout,
+        "requests/s": len(results) / wall,
+        "overall p99 (ms)": float(np.percentile(results["latency"], 99) *
+                                  1000),
+        "callbacks": json.loads(summary.to_json(orient="index")),
+    }
+    report_dir = PROJECT_DIR / "reports" / "benchmarks"
+    report_dir.mkdir(parents=True, exist_ok=True)
+    f = report_dir / f"dash-{datetime.datetime.now():%Y%m%dT%H%M%S}.json"
+    with open(f, "w") as fd:
+        json.dump(report, fd, indent=2)
+    LOG.info(f"Results written to '{f}'")
+
+
+if __name__ == '__main__':
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings to serve the dashboard (see `wsgi.py`).
+
+Workers and threads per worker can be set with the `WEB_CONCURRENCY` and
+`GUNICORN_THREADS` environment variables, and the address with `BIND`.
+"""
+
+import gc
+import multiprocessing
+import os
+import pathlib
+
+wsgi_app = "src.visualization.wsgi:server"
+chdir = str(pathlib.Path(__file__).resolve().parents[2])
+
+bind = os.environ.get("BIND", "0.0.0.0:8050")
+workers = int(os.environ.get("WEB_CONCURRENCY",
+                             min(multiprocessing.cpu_count(), 4)))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Load the app and its data in the master, once for all the workers
+preload_app = True
+timeout = 120
+
+
+def when_ready(server):
+    # Keep the garbage collector from writing to the objects loaded before
+    # forking, which would copy their pages into every worker
+    gc.freeze()
@@ -0,0 +1,22 @@
+import json
+
+
+def load_geometry(data_dir, name, zoom):
+    """Load the boundaries in `name`, simplified for display at `zoom`.
+
+    Take the coarsest level written by `src/data/simplify_geometry.py` that
+    is still detailed enough for `zoom`, or the original file if there is
+    none.
+    """
+    levels = sorted(
+        int(f.stem.rsplit("-z", 1)[1])
+        for f in (data_dir / "processed").glob(f"{name}-z*.geojson")
+    )
+    f = data_dir / "external" / f"{name}.geojson"
+    for z in levels:
+        if z >= zoom:
+            f = data_dir / "processed" / f"{name}-z{z}.geojson"
+            break
+
+    with open(f, "r") as fd:
+        return json.load(fd)
@@ -1,18 +1,23 @@
-import json
 import pathlib
 
 from dotenv import find_dotenv, load_dotenv
 import pandas
 import plotly
 
+import utils
+
+# Map zoom at which Cantabria is displayed
+CANTABRIA_ZOOM = 9
+
 
 def main(data_dir):
     incidence = pandas.read_csv(
         data_dir / "processed" / "cantabria-incidence.csv"
     )
 
-    with open(data_dir / "external" / "municipios-cantabria.geojson", "r") as f:
-        municipalities = json.load(f)
+    municipalities = utils.load_geometry(
+        data_dir, "municipios-cantabria", CANTABRIA_ZOOM
+    )
 
     fig = plotly.graph_objects.Figure(
         plotly.graph_objects.Choroplethmapbox(
@@ -36,7 +41,7 @@ def main(data_dir):
 
     fig.update_layout(
         mapbox_style="carto-positron",
-        mapbox_zoom=9,
+        mapbox_zoom=CANTABRIA_ZOOM,
         mapbox_center={
             "lat": 43.16513048333179,
             "lon": -3.8942754858409394
@@ -11,52 +11,356 @@ app = dash.Dash(__name__,
 """
 
 
+import datetime
+import hashlib
 import json
+import logging
+import os
 import pathlib
+import threading
+import time
 
 import plotly
 import plotly.express as px
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from dotenv import find_dotenv, load_dotenv
+import numpy as np
 import pandas as pd
 
+from src.data import utils as data_utils
+from src.visualization import utils
 
-def main(data_dir):
+LOG = logging.getLogger(__name__)
 
-    # Load data
-    with open(data_dir / "external" / "municipios-cantabria.geojson", "r") as f:
-        municipalities = json.load(f)
+# Map zoom at which Cantabria and Spain are displayed
+CANTABRIA_ZOOM = 9
+SPAIN_ZOOM = 4
+
+# Seconds between checks for new processed data
+RELOAD_INTERVAL = 60
+
+# Processed datasets shown, and the metrics of each plot
+DATASETS = ["cantabria-incidence", "provinces-incidence"]
+CANTABRIA_METRICS = ['Activos', 'Curados', 'Casos', 'Fallecidos',
+                     'incidence rel', 'incidence 7', 'incidence 14',
+                     'incidence 100k']
+CANTABRIA_DEFAULT_METRIC = 'incidence 100k'
+SPAIN_METRICS = ['cases new (pcr)', 'cases acc (pcr)', 'cases inc (pcr)',
+                 'incidence 7', 'incidence 14']
+MAP_METRICS = ['incidence 7', 'incidence 14']
+
+
+def source_signature(path):
+    """Modification time and size of the files making up a dataset."""
+    files = [path] if path.is_file() else sorted(path.rglob("*.parquet"))
+    return [
+        [str(f.relative_to(path.parent)), f.stat().st_mtime_ns,
+         f.stat().st_size]
+        for f in files
+    ]
+
+
+def data_version(data_dir, names):
+    """Short hash identifying the current contents of processed datasets."""
+    signature = [source_signature(data_utils.processed_path(data_dir, name))
+                 for name in names]
+    return hashlib.sha1(json.dumps(signature).encode()).hexdigest()[:12]
 
-    incidence = pd.read_csv(
-        data_dir / "processed" / "cantabria-incidence.csv"
+
+def regions_weekly(provinces, metrics):
+    """Average the province metrics by region and week."""
+    provinces = provinces.assign(date=pd.to_datetime(provinces['date']))
+    df = provinces.groupby(['region id', 'region']).resample(
+        rule='W', on='date'
+    )[metrics].mean()
+    return df.reset_index()
+
+
+def load_regions_weekly(data_dir, metrics):
+    """Load the weekly regional series, computing it only if it is stale.
+
+    The series is cached in `processed` together with the signature of the
+    province dataset it was computed from.
+    """
+    source = data_utils.processed_path(data_dir, "provinces-incidence")
+    f = data_dir / "processed" / "regions-incidence-weekly.csv"
+    f_meta = f.with_suffix(".json")
+
+    meta = {
+        "source": source_signature(source),
+        "metrics": metrics,
+    }
+    if f.exists() and f_meta.exists():
+        with open(f_meta, "r") as fd:
+            if json.load(fd) == meta:
+                return pd.read_csv(f, parse_dates=['date'],
+                                   float_precision='round_trip')
+
+    provinces = data_utils.read_processed(
+        data_dir,
+        "provinces-incidence",
+        columns=['date', 'region id', 'region'] + metrics,
     )
-    cantabria_metrics = ['Activos', 'Curados', 'Casos', 'Fallecidos', 'incidence rel', 'incidence 100k']
+    df = regions_weekly(provinces, metrics)
+
+    # Written aside and moved, as several server workers may be reloading
+    tmp = f.with_suffix(f".{os.getpid()}.tmp")
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, f)
+    with open(tmp, "w") as fd:
+        json.dump(meta, fd)
+    os.replace(tmp, f_meta)
 
-    provinces = pd.read_csv(
-        data_dir / "processed" / "provinces-incidence.csv"
+    return df
+
+
+def cantabria_figure(municipalities, incidence):
+    """Choropleth of the Cantabria municipalities, without values.
+
+    The values of each metric are filled in on the client, so that the
+    geometry is only sent once with the layout.
+    """
+    fig = plotly.graph_objects.Figure(
+        plotly.graph_objects.Choroplethmapbox(
+            geojson=municipalities,
+            featureidkey="properties.COD_INE",
+            locations=incidence["Codigo"],
+            z=[],
+            text=incidence['Municipio'],
+            colorscale="Cividis",
+            reversescale=True,
+            showlegend=False,
+            showscale=False,
+            marker={
+                "line": {
+                    "width": 0.1
+                },
+                "opacity": 0.5
+            },
+        )
     )
-    spain_metrics = ['cases new (pcr)', 'cases acc (pcr)', 'cases inc (pcr)', 'incidence 7', 'incidence 14']
 
-    # Define Dash app
-    app = dash.Dash(__name__)
+    fig.update_layout(
+        title='COVID-19 Data (Cantabria)',
+        autosize=True,
+        mapbox_style="carto-positron",
+        mapbox_zoom=CANTABRIA_ZOOM,
+        mapbox_center={
+            "lat": 43.16513048333179,
+            "lon": -3.8942754858409394
+        },
+        margin={"r": 0, "t": 0, "l": 0, "b": 0}
+    )
+
+    return fig.to_dict()
+
+
+def incidence_matrix(provinces, metrics):
+    """Dense date x province matrices of the given metrics.
+
+    Rows follow `dates` and columns follow `ids`, so that the values of all
+    the provinces on a date are a single row, with NaN where there is no
+    data.
+    """
+    dates = pd.DatetimeIndex(pd.to_datetime(provinces['date'])).unique()
+    dates = dates.sort_values()
+    ids = np.sort(provinces['province id'].unique())
+
+    rows = dates.get_indexer(pd.to_datetime(provinces['date']))
+    cols = np.searchsorted(ids, provinces['province id'])
+
+    values = {}
+    for m in metrics:
+        values[m] = np.full((len(dates), len(ids)), np.nan, dtype="float32")
+        values[m][rows, cols] = provinces[m].values
+
+    return dates, ids, values
+
+
+def provinces_figure(geometry, ids):
+    """Choropleth of the Spain provinces, without values.
+
+    As for Cantabria, the values are filled in on the client.
+    """
+    names = {
+        int(f["properties"]["province id"]): f["properties"]["province"]
+        for f in geometry["features"]
+    }
+    fig = plotly.graph_objects.Figure(
+        plotly.graph_objects.Choroplethmapbox(
+            geojson=geometry,
+            featureidkey="properties.province id",
+            locations=[f"{i:02d}" for i in ids],
+            z=[],
+            text=[names.get(i, "") for i in ids],
+            zmin=0,
+            colorscale="Cividis",
+            reversescale=True,
+            showlegend=False,
+            marker={
+                "line": {
+                    "width": 0.1
+                },
+                "opacity": 0.5
+            },
+        )
+    )
+
+    fig.update_layout(
+        autosize=True,
+        mapbox_style="carto-positron",
+        mapbox_zoom=SPAIN_ZOOM,
+        mapbox_center={
+            "lat": 38.5,
+            "lon": -7.5
+        },
+        margin={"r": 0, "t": 0, "l": 0, "b": 0}
+    )
+
+    return fig.to_dict()
+
+
+def spain_figure(data, spain_metric):
+    """Weekly cases of the regions, for `spain_metric`."""
+    fig = px.line(data["regions weekly"], x='date', y=spain_metric,
+                  color='region')
+    for d in fig.data:
+        d.update(mode='markers+lines')
+    return fig.to_dict()
+
+
+def load_data(data_dir):
+    """Load and preprocess the processed datasets shown in the dashboard.
+
+    The version is taken before reading, so that datasets changing while
+    they are read are seen as changed by the next check.
+    """
+    version = data_version(data_dir, DATASETS)
+
+    incidence = data_utils.read_processed(data_dir, "cantabria-incidence",
+                                          date="Fecha")
+    reg_output = load_regions_weekly(data_dir, SPAIN_METRICS)
+
+    dates, ids, matrix = incidence_matrix(
+        data_utils.read_processed(
+            data_dir,
+            "provinces-incidence",
+            columns=['date', 'province id'] + MAP_METRICS,
+        ),
+        MAP_METRICS,
+    )
+    # Fixed color range per metric, so that dates can be compared
+    zmax = {m: float(np.nanpercentile(v, 99)) for m, v in matrix.items()}
+
+    return {
+        "version": version,
+        "loaded": datetime.datetime.now(),
+        "incidence": incidence,
+        "regions weekly": reg_output,
+        "dates": dates,
+        "ids": ids,
+        "matrix": matrix,
+        "zmax": zmax,
+        # Figures built on this data, by metric
+        "figures": {},
+    }
+
+
+def cached(data, key, build):
+    """Memoized `build(data)` of a data snapshot, by `key`.
+
+    The memo is part of the snapshot, so that reloaded data starts with an
+    empty one and figures of the old data are freed with it.
+    """
+    figures = data["figures"]
+    if key not in figures:
+        figures[key] = build(data)
+    return figures[key]
+
+
+class DataWatcher:
+    """Keep the dashboard data up to date with the processed datasets.
+
+    A background thread checks the version of the datasets every `interval`
+    seconds. Once a new version has stayed the same for two checks, i.e.
+    the datasets are no longer being written, it is loaded with `load` in
+    the thread and swapped in as a whole, so that requests see either the
+    old or the new data.
+
+    The thread is started by `start`, in the process serving the requests,
+    as threads do not survive the fork of the server workers.
+    """
+
+    def __init__(self, load, version, interval=RELOAD_INTERVAL):
+        self.load = load
+        self.version = version
+        self.interval = interval
+        self.data = load()
+        self._pending = None
+        self._pid = None
+        self._lock = threading.Lock()
 
-    app.layout = html.Div(children=[
+    def start(self):
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                LOG.exception("Cannot reload the data, keeping the current")
+
+    def check(self):
+        """Reload the data if a new version is ready."""
+        version = self.version()
+        if version == self.data["version"] or version != self._pending:
+            self._pending = version
+            return
+
+        LOG.info(f"Loading data version {version}")
+        self.data = self.load()
+        self._pending = None
+
+
+def dashboard_layout(data, municipalities, provinces_geometry):
+    """Layout of the dashboard for the given data."""
+    dates = data["dates"]
+    incidence = data["incidence"]
+
+    day = f"{incidence['Fecha'][0]:%d/%m/%Y}"
+
+    return html.Div(children=[
         html.Div([
-            html.H1(children=f"Covid Cases in Cantabria ({incidence['Fecha'][0]})"),
+            html.P(id="data_version"),
+            dcc.Store(id="page_version", data=data["version"]),
+            dcc.Interval(id="data_version_check",
+                         interval=(RELOAD_INTERVAL or 60) * 1000),
+            ]),
+        html.Div([
+            html.H1(children=f"Covid Cases in Cantabria ({day})"),
             html.P("Metric:"),
             dcc.RadioItems(
                 id='cantabria_metric',
                 options=[{'value': x, 'label': x}
-                         for x in cantabria_metrics],
-                value=cantabria_metrics[-1],
+                         for x in CANTABRIA_METRICS],
+                value=CANTABRIA_DEFAULT_METRIC,
                 labelStyle={'display': 'inline-block'}
             ),
             dcc.Graph(id="choropleth_cantabria",
                       style={"height": "100vh", "width": "90vw"}
                       ),
+            dcc.Store(id="cantabria_base",
+                      data=cantabria_figure(municipalities, incidence)),
+            dcc.Store(id="cantabria_values"),
             ]),
         html.Div([
             html.H1(children='Daily Covid cases in Spain (averaged by week)'),
@@ -64,14 +368,42 @@ def main(data_dir):
             dcc.RadioItems(
                 id='spain_metric',
                 options=[{'value': x, 'label': x}
-                         for x in spain_metrics],
-                value=spain_metrics[-1],
+                         for x in SPAIN_METRICS],
+                value=SPAIN_METRICS[-1],
                 labelStyle={'display': 'inline-block'}
             ),
             dcc.Graph(id="covid_spain",
                       style={"height": "100vh"}
                       ),
         ]),
+        html.Div([
+            html.H1(children='Covid incidence by province'),
+            html.P("Metric:"),
+            dcc.RadioItems(
+                id='spain_map_metric',
+                options=[{'value': x, 'label': x}
+                         for x in MAP_METRICS],
+                value=MAP_METRICS[-1],
+                labelStyle={'display': 'inline-block'}
+            ),
+            html.P(id='spain_map_date'),
+            dcc.Slider(
+                id='spain_map_day',
+                min=0,
+                max=len(dates) - 1,
+                value=len(dates) - 1,
+                marks={i: f"{d:%m/%y}" for i, d in enumerate(dates)
+                       if d.day == 1},
+                updatemode='drag',
+            ),
+            dcc.Graph(id="choropleth_spain",
+                      style={"height": "100vh", "width": "90vw"}
+                      ),
+            dcc.Store(id="spain_base",
+                      data=provinces_figure(provinces_geometry,
+                                            data["ids"])),
+            dcc.Store(id="spain_values"),
+        ]),
         html.Div([
             html.H1(children='Mobility data from MITMA'),
             html.Iframe(src="https://flowmap.blue/from-url?flows=https://raw.githubusercontent.com/IFCA/mitma-covid/main/data/processed/flowmap-blue/flows.csv&locations=https://raw.githubusercontent.com/IFCA/mitma-covid/main/data/processed/flowmap-blue/locations.csv&f=13&col=BurgYl&c=0&bo=100",
@@ -82,75 +414,156 @@ def main(data_dir):
         ]),
     ])
 
+
+def create_app(data_dir, reload_interval=RELOAD_INTERVAL):
+    """Build the dashboard on the processed data in `data_dir`.
+
+    All the data is loaded here, so that when the app is created before
+    forking the server workers (see `wsgi.py`) they share it. It is then
+    reloaded when the processed datasets change, checking every
+    `reload_interval` seconds (never if None).
+    """
+
+    # Load data
+    municipalities = utils.load_geometry(
+        data_dir, "municipios-cantabria", CANTABRIA_ZOOM
+    )
+    provinces_geometry = utils.load_geometry(
+        data_dir, "provincias-espana", SPAIN_ZOOM
+    )
+
+    def load():
+        data = load_data(data_dir)
+        data["layout"] = dashboard_layout(data, municipalities,
+                                          provinces_geometry)
+        return data
+
+    watcher = DataWatcher(
+        load,
+        lambda: data_version(data_dir, DATASETS),
+        interval=reload_interval,
+    )
+
+    # Define Dash app
+    app = dash.Dash(__name__)
+
+    # New page loads get the layout of the current data
+    app.layout = lambda: watcher.data["layout"]
+
+    app.server.before_request(watcher.start)
+
+    register_callbacks(app, watcher)
+
+    return app
+
+
+def register_callbacks(app, watcher):
+    """Add the callbacks of the dashboard, on the data of `watcher`.
+
+    Each callback reads the current data once, so that it builds its output
+    from a single snapshot even if new data is loaded meanwhile.
+    """
+
+    # Show the data version, and whether the page is outdated
+    ##########################################################
+
+    @app.callback(
+        Output("data_version", "children"),
+        [Input("data_version_check", "n_intervals")],
+        [State("page_version", "data")])
+    def display_version(n, page_version):
+        data = watcher.data
+        text = (f"Data version {data['version']}, "
+                f"loaded {data['loaded']:%Y-%m-%d %H:%M}")
+        if data["version"] != page_version:
+            text += ". New data available, reload the page to see it."
+        return text
+
     # Plot cases in Cantabria map (for yesterday)
     ############################################
 
     @app.callback(
-        Output("choropleth_cantabria", "figure"),
+        Output("cantabria_values", "data"),
         [Input("cantabria_metric", "value")])
     def display_choropleth(map_metric):
-        fig = plotly.graph_objects.Figure(
-            plotly.graph_objects.Choroplethmapbox(
-                geojson=municipalities,
-                featureidkey="properties.COD_INE",
-                locations=incidence["Codigo"],
-                z=incidence[map_metric],
-                text=incidence['Municipio'],
-                colorscale="Cividis",
-                reversescale=True,
-                showlegend=False,
-                showscale=False,
-                marker={
-                    "line": {
-                        "width": 0.1
-                    },
-                    "opacity": 0.5
-                },
-            )
-        )
-
-        fig.update_layout(
-            title='COVID-19 Data (Cantabria)',
-            autosize=True,
-            mapbox_style="carto-positron",
-            mapbox_zoom=9,
-            mapbox_center={
-                "lat": 43.16513048333179,
-                "lon": -3.8942754858409394
-            },
-            margin={"r": 0, "t": 0, "l": 0, "b": 0}
-        )
+        data = watcher.data
+        return cached(data, ("cantabria", map_metric), lambda data: {
+            "version": data["version"],
+            "z": data["incidence"][map_metric].tolist(),
+        })
 
-        return fig
-
-    # Plot daily cases in Spain (averaged by week)
-    #############################################
+    # Only the values travel on metric changes, the geometry stays in the
+    # browser since the page load. Values of a newer version than the page
+    # may not match its geometry, and are left out until it is reloaded.
+    app.clientside_callback(
+        """
+        function(values, base, version) {
+            if (!values || values.version !== version) {
+                return window.dash_clientside.no_update;
+            }
+            const trace = Object.assign({}, base.data[0], {z: values.z});
+            return Object.assign({}, base, {data: [trace]});
+        }
+        """,
+        Output("choropleth_cantabria", "figure"),
+        [Input("cantabria_values", "data")],
+        [State("cantabria_base", "data"), State("page_version", "data")])
 
-    provinces['date'] = pd.to_datetime(provinces['date'])
-    reg_output = pd.DataFrame()
+    # Plot incidence by province in Spain (for the selected date)
+    ##############################################################
 
-    for region_id in set(provinces['region id']):
-        reg = provinces.loc[provinces['region id'] == region_id]
+    @app.callback(
+        Output("spain_values", "data"),
+        [Input("spain_map_metric", "value"),
+         Input("spain_map_day", "value")])
+    def display_choropleth_spain(map_metric, day):
+        data = watcher.data
+        dates = data["dates"]
+        day = min(day, len(dates) - 1)
+        return {
+            "version": data["version"],
+            "date": f"Date: {dates[day]:%Y-%m-%d}",
+            "z": data["matrix"][map_metric][day].tolist(),
+            "zmax": data["zmax"][map_metric],
+        }
 
-        region = reg['region'].values[0]
-        reg = reg.drop(['region id', 'province id'], 'columns')
+    # The date is shown along the values, so that the dates of a newer
+    # version are not shown on the slider of the page either
+    app.clientside_callback(
+        """
+        function(values, base, version) {
+            if (!values || values.version !== version) {
+                const no_update = window.dash_clientside.no_update;
+                return [no_update, no_update];
+            }
+            const trace = Object.assign({}, base.data[0],
+                                        {z: values.z, zmax: values.zmax});
+            return [Object.assign({}, base, {data: [trace]}), values.date];
+        }
+        """,
+        [Output("choropleth_spain", "figure"),
+         Output("spain_map_date", "children")],
+        [Input("spain_values", "data")],
+        [State("spain_base", "data"), State("page_version", "data")])
 
-        s = reg.resample(rule='W', on='date').mean()
-        s = s.reset_index()
-        s.insert(0, 'region id', region_id)
-        s.insert(1, 'region', region)
-        reg_output = pd.concat([reg_output, s], ignore_index=True)
+    # Plot daily cases in Spain (averaged by week)
+    #############################################
 
     @app.callback(
         Output("covid_spain", "figure"),
         [Input("spain_metric", "value")])
     def update_line_chart(spain_metric):
-        fig = px.line(reg_output, x='date', y=spain_metric, color='region')
-        for d in fig.data:
-            d.update(mode='markers+lines')
-        return fig
+        return cached(watcher.data, ("spain", spain_metric),
+                      lambda data: spain_figure(data, spain_metric))
+
+
+def main(data_dir):
+    """Serve the dashboard with the development server.
 
-    app.run_server(debug=True)
+    Debug mode is off unless the `DASH_DEBUG` environment variable is set.
+    """
+    app = create_app(data_dir)
+    app.run_server()
 
 
 if __name__ == '__main__':
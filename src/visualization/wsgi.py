@@ -0,0 +1,27 @@
+"""
+WSGI entry point of the dashboard, for serving it with several workers:
+
+    gunicorn -c src/visualization/gunicorn.conf.py
+
+The app, and so all its data, is created when this module is imported. With
+the `preload_app` setting of `gunicorn.conf.py` that happens once in the
+master process, before forking the workers, which then share the loaded
+data copy-on-write instead of loading it each.
+
+The data is read from `DATA_DIR`, if set, or else from the project `data`.
+"""
+
+import os
+import pathlib
+
+from dotenv import find_dotenv, load_dotenv
+
+from src.visualization import visualize_dash
+
+load_dotenv(find_dotenv())
+
+project_dir = pathlib.Path(__file__).resolve().parents[2]
+data_dir = pathlib.Path(os.environ.get("DATA_DIR", project_dir / "data"))
+
+app = visualize_dash.create_app(data_dir)
+server = app.server
@@ -0,0 +1,19 @@
+import pathlib
+import sys
+
+import pytest
+
+# The scripts in src/data import their sibling modules, and the others the
+# src package
+PROJECT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_DIR / "src" / "data"))
+sys.path.insert(0, str(PROJECT_DIR))
+
+import synthetic  # noqa: E402
+
+
+@pytest.fixture
+def raw(tmp_path):
+    """Synthetic raw cases and fluxes of 8 provinces over 30 days."""
+    synthetic.generate(tmp_path / "synthetic", days=30, n_provinces=8)
+    return tmp_path / "synthetic"
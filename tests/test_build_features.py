@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+
+import adjacency
+import make_dataset
+from src.features import build_features
+
+
+def test_origins_of_dates_after_the_fluxes(raw):
+    # The fluxes end 4 days before the cases
+    f = raw / "raw" / "province_flux.csv"
+    fluxes = pd.read_csv(f)
+    fluxes.loc[fluxes["date"] <= "2020-03-26"].to_csv(f, index=False)
+    make_dataset.prepare_dataset(raw)
+    adjacency.write_adjacency(raw)
+
+    df = pd.read_csv(raw / "processed" / "provinces-incidence.csv",
+                     parse_dates=["date"])
+    dates, _, names, features, _ = build_features.build_features(df, raw)
+
+    origins = features[:, :, names.index("incidence 7 origins lag 1")]
+    assert dates[-1] == pd.Timestamp("2020-03-31")
+    assert np.isfinite(origins[:, dates > "2020-03-27"]).all()
@@ -0,0 +1,104 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import make_dataset
+import utils
+
+CASES = "casos_tecnica_provincias.csv"
+FLUX = "province_flux.csv"
+
+
+def copy_raw(raw, base_dir, cases_end=None, flux_end=None, drop=None):
+    """Copy the raw data up to the given dates, without the cases of `drop`
+    (ISO code, first date)."""
+    shutil.copytree(raw, base_dir)
+    cases = pd.read_csv(raw / "raw" / CASES, keep_default_na=False)
+    fluxes = pd.read_csv(raw / "raw" / FLUX)
+    if drop is not None:
+        iso, start = drop
+        cases = cases.loc[~((cases["provincia_iso"] == iso) &
+                            (cases["fecha"] >= start))]
+    if cases_end is not None:
+        cases = cases.loc[cases["fecha"] <= cases_end]
+    if flux_end is not None:
+        fluxes = fluxes.loc[fluxes["date"] <= flux_end]
+    cases.to_csv(base_dir / "raw" / CASES, index=False)
+    fluxes.to_csv(base_dir / "raw" / FLUX, index=False)
+
+
+def read(base_dir, fmt, name):
+    levels = 2 if name == "provinces-incidence-mobility" else 1
+    df = utils.read_processed(base_dir, name, fmt, levels=levels)
+    date = df.columns[0]
+    return df.sort_values([date, df.columns[1]], ignore_index=True)
+
+
+def run_incremental(raw, full, inc, fmt, cases_end, flux_end, drop=None):
+    """Process the raw data in `full` at once, and in `inc` up to the given
+    dates first and then incrementally."""
+    copy_raw(raw, full, drop=drop)
+    make_dataset.prepare_dataset(full, fmt=fmt)
+
+    copy_raw(raw, inc, cases_end=cases_end, flux_end=flux_end, drop=drop)
+    make_dataset.prepare_dataset(inc, fmt=fmt)
+    shutil.rmtree(inc / "raw")
+    shutil.copytree(full / "raw", inc / "raw")
+    make_dataset.prepare_dataset(inc, incremental=True, fmt=fmt)
+
+
+def assert_same_datasets(full, inc, fmt):
+    for name in ["provinces-incidence", "provinces-incidence-mobility"]:
+        pd.testing.assert_frame_equal(read(inc, fmt, name),
+                                      read(full, fmt, name))
+
+    f = "processed/province-flux.npy"
+    np.testing.assert_array_equal(np.load(inc / f), np.load(full / f))
+
+
+@pytest.mark.parametrize("fmt", make_dataset.OUTPUT_FORMATS)
+def test_incremental_province_without_new_cases(raw, tmp_path, fmt):
+    # Asturias has fluxes but no cases on the dates of the second run
+    full, inc = tmp_path / "full", tmp_path / "inc"
+    run_incremental(raw, full, inc, fmt, "2020-03-18", "2020-03-18",
+                    drop=("O", "2020-03-19"))
+    assert_same_datasets(full, inc, fmt)
+
+
+@pytest.mark.parametrize("fmt", make_dataset.OUTPUT_FORMATS)
+def test_incremental_mobility_lag(raw, tmp_path, fmt):
+    # The fluxes of the last cases of the first run come in the second
+    full, inc = tmp_path / "full", tmp_path / "inc"
+    run_incremental(raw, full, inc, fmt, "2020-03-18", "2020-03-14")
+    assert_same_datasets(full, inc, fmt)
+
+
+@pytest.mark.parametrize("partition_cols", [None, ["province id"]])
+def test_parquet_appends_are_compacted(tmp_path, monkeypatch, partition_cols):
+    monkeypatch.setattr(make_dataset, "PARQUET_MAX_FILES", 2)
+    (tmp_path / "processed").mkdir()
+    dates = pd.date_range("2020-03-01", periods=5)
+    df = pd.DataFrame({
+        "date": dates.repeat(2),
+        "province id": [1, 2] * len(dates),
+        "province": ["A", "B"] * len(dates),
+        "region": ["R", "R"] * len(dates),
+        "cases new (pcr)": range(2 * len(dates)),
+    })
+    for i, d in enumerate(dates):
+        make_dataset.write_dataset(df.loc[df["date"] == d],
+                                   "provinces-incidence", tmp_path, "parquet",
+                                   append=i > 0,
+                                   partition_cols=partition_cols)
+
+    f = tmp_path / "processed" / "provinces-incidence.parquet"
+    for d in {i.parent for i in f.rglob("*.parquet")}:
+        assert len(list(d.glob("*.parquet"))) <= 2
+    assert not list(f.rglob(".*"))
+    pd.testing.assert_frame_equal(
+        read(tmp_path, "parquet", "provinces-incidence")[df.columns],
+        df.astype({"province id": "int"}),
+        check_dtype=False,
+    )
@@ -0,0 +1,68 @@
+import numpy as np
+
+import simplify_geometry
+
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size],
+            [x, y]]
+
+
+def geojson_rings(collection):
+    return [
+        ring
+        for f in collection["features"]
+        for poly in simplify_geometry.polygons(f["geometry"])
+        for ring in poly
+    ]
+
+
+def topojson_rings(topology):
+    """Decode the rings of a TopoJSON topology into coordinates."""
+    transform = topology["transform"]
+    arcs = [
+        np.cumsum(a, axis=0) * transform["scale"] + transform["translate"]
+        for a in topology["arcs"]
+    ]
+    (geometries,) = [o["geometries"] for o in topology["objects"].values()]
+    return [
+        np.concatenate([arcs[i] if i >= 0 else arcs[~i][::-1] for i in refs])
+        for g in geometries
+        for poly in (g["arcs"] if g["type"] == "MultiPolygon" else [g["arcs"]])
+        for refs in poly
+    ]
+
+
+def valid(rings):
+    return sum(len(np.unique(np.array(r), axis=0)) >= 3 for r in rings)
+
+
+def test_small_rings_are_kept_in_both_formats():
+    # A province with an island far smaller than a pixel at every zoom, and
+    # another one smaller than the grid of the coordinates
+    features = [
+        {
+            "type": "Feature",
+            "properties": {"name": "big"},
+            "geometry": {"type": "Polygon",
+                         "coordinates": [square(-4, 40, 1)]},
+        },
+        {
+            "type": "Feature",
+            "properties": {"name": "islands"},
+            "geometry": {"type": "MultiPolygon",
+                         "coordinates": [[square(-3, 40, 1)],
+                                         [square(-1, 40, 1e-4)],
+                                         [square(1, 40, 1e-7)]]},
+        },
+    ]
+    topology = simplify_geometry.Topology(features)
+
+    for zoom in simplify_geometry.ZOOMS:
+        tolerance = simplify_geometry.pixel_size(zoom) / 2
+        arcs = topology.simplify(tolerance, 6)
+        geojson = simplify_geometry.to_geojson(topology, arcs, 6)
+        topojson = simplify_geometry.to_topojson(topology, arcs, "test", 6)
+
+        for rings in [geojson_rings(geojson), topojson_rings(topojson)]:
+            assert len(rings) == valid(rings) == 3